@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+""" Benchmark the time it takes to import srllib modules.
+
+Each module is imported in a fresh interpreter, since modules are only
+imported once per process, and the time of the import statement itself is
+measured there. The best of a number of runs is reported in milliseconds,
+along with the number of modules the import pulled in. Modules that can't be
+imported (e.g. srllib.qtgui without PyQt4) are reported as such.
+
+Usage: benchimport.py [number of runs]
+"""
+import sys, os.path, subprocess
+
+_Root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.path.pardir)
+
+# Executed in the child interpreter, printing the import time and the number
+# of modules loaded by the import
+_Script = """\
+import sys, time
+sys.path.insert(0, %r)
+before = len(sys.modules)
+start = time.time()
+try: import %s
+except ImportError:
+    sys.exit(1)
+print time.time() - start, len(sys.modules) - before
+"""
+
+def measure(module, runs):
+    best = None
+    for i in range(runs):
+        proc = subprocess.Popen([sys.executable, "-c", _Script % (_Root,
+            module)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            print "%-20s unavailable" % (module,)
+            return
+        elapsed, num_modules = out.split()
+        elapsed = float(elapsed)
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-20s %8.2f ms %6s modules" % (module, best * 1000, num_modules)
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for module in ("srllib.util", "srllib.process", "srllib.qtgui"):
+        measure(module, runs)
+
+if __name__ == "__main__":
+    main()
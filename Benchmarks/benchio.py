@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+""" Benchmark file hashing and copying throughput in srllib.util.
+
+A large file is created in a temporary directory, and then hashed and copied
+with the original 8 KB read()-based loops as well as with util.get_checksum
+and util.copy_file at different block sizes, and with in-kernel copying
+disabled. Throughput is reported in MB/s.
+Since the file was just written, it will normally be in the page cache, so the
+numbers reflect the overhead of the I/O loops rather than disk speed.
+
+Usage: benchio.py [size in MB]
+"""
+import sys, os.path, time, tempfile, hashlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.path.pardir))
+from srllib import util
+
+MB = 1024 * 1024
+
+def legacy_checksum(path):
+    """ Hash a file the way get_checksum used to. """
+    sha_obj = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            bytes = f.read(8192)
+            sha_obj.update(bytes)
+            if len(bytes) < 8192:
+                break
+    finally:
+        f.close()
+    return sha_obj.hexdigest()
+
+def legacy_copy(srcpath, dstpath):
+    """ Copy a file the way _copy_file used to. """
+    src = open(srcpath, "rb")
+    dst = open(dstpath, "wb")
+    try:
+        while True:
+            bytes = src.read(8192)
+            dst.write(bytes)
+            if len(bytes) < 8192:
+                break
+    finally:
+        src.close()
+        dst.close()
+
+def measure(label, size, func, *args, **kwds):
+    # Best of three runs
+    best = None
+    for i in range(3):
+        start = time.time()
+        func(*args, **kwds)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-40s %8.1f MB/s" % (label, size / float(MB) / best)
+
+def main():
+    size = int(sys.argv[1]) * MB if len(sys.argv) > 1 else 512 * MB
+    dpath = tempfile.mkdtemp()
+    try:
+        srcpath, dstpath = (os.path.join(dpath, "src"), os.path.join(dpath,
+            "dst"))
+        f = open(srcpath, "wb")
+        try:
+            block = os.urandom(MB)
+            for i in range(size // MB):
+                f.write(block)
+        finally:
+            f.close()
+
+        print "Hashing %d MB file" % (size // MB,)
+        measure("8 KB read() (before)", size, legacy_checksum, srcpath)
+        for blocksize in (8192, MB, 4 * MB, 16 * MB):
+            measure("get_checksum, %d KB readinto()" % (blocksize // 1024,),
+                    size, util.get_checksum, srcpath, blocksize=blocksize)
+        measure("get_checksum, mmap", size, util.get_checksum, srcpath,
+                mmap_threshold=0)
+
+        print "Copying %d MB file" % (size // MB,)
+        measure("8 KB read() (before)", size, legacy_copy, srcpath, dstpath)
+        for blocksize in (8192, MB, 4 * MB, 16 * MB):
+            measure("copy_file, %d KB blocks" % (blocksize // 1024,),
+                    size, util.copy_file, srcpath, dstpath,
+                    blocksize=blocksize)
+        # Disable in-kernel copying (copy_file_range/sendfile)
+        kernel_copiers, util._kernel_copiers = util._get_kernel_copiers(), []
+        try:
+            measure("copy_file, 1024 KB blocks, no kernel copying", size,
+                    util.copy_file, srcpath, dstpath)
+        finally:
+            util._kernel_copiers = kernel_copiers
+    finally:
+        util.remove_dir(dpath)
+
+if __name__ == "__main__":
+    main()
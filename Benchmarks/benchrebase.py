@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+""" Benchmark the per-entry overhead of rebasing paths in srllib.util.
+
+Paths for a synthetic tree are generated in memory, the way walkdir yields
+them, and moved to another root with util.replace_root as well as with
+util.PathRebaser (per path, per relative path and in batches per directory).
+The overhead is reported in microseconds per entry.
+
+Usage: benchrebase.py [number of entries]
+"""
+import sys, os.path, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.path.pardir))
+from srllib import util
+
+def create_tree(root, num):
+    """ Generate directories of 100 files each, as pairs of directory path and
+    file paths.
+    """
+    tree = []
+    for i in range(num // 100):
+        dpath = os.path.join(root, "dir%d" % (i // 100), "subdir%d" % (i,))
+        tree.append((dpath, [os.path.join(dpath, "file%d" % (j,)) for j in
+            range(100)]))
+    return tree
+
+def measure(label, num, func, *args):
+    # Best of three runs
+    best = None
+    for i in range(3):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-40s %8.3f us/entry" % (label, best / num * 1000000)
+
+def replace_root(tree, srcdir, dstdir):
+    for dpath, fpaths in tree:
+        for fpath in fpaths:
+            util.replace_root(fpath, dstdir, srcdir)
+
+def rebase(tree, srcdir, dstdir):
+    rebaser = util.PathRebaser(srcdir, dstdir)
+    for dpath, fpaths in tree:
+        for fpath in fpaths:
+            rebaser.rebase(fpath)
+
+def rebase_relative(tree, srcdir, dstdir):
+    rebaser = util.PathRebaser(srcdir, dstdir)
+    prefix_len = len(os.path.join(srcdir, ""))
+    for dpath, fpaths in tree:
+        for fpath in fpaths:
+            rebaser.rebase_relative(fpath[prefix_len:])
+
+def rebase_many(tree, srcdir, dstdir):
+    rebaser = util.PathRebaser(srcdir, dstdir)
+    for dpath, fpaths in tree:
+        rebaser.rebase_many(fpaths)
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    srcdir, dstdir = (os.path.join(os.sep, "scratch", "jobs", "src"),
+            os.path.join(os.sep, "scratch", "jobs", "dst"))
+    tree = create_tree(srcdir, num)
+    num = sum([len(fpaths) for dpath, fpaths in tree])
+
+    print "Rebasing %d paths" % (num,)
+    measure("replace_root (before)", num, replace_root, tree, srcdir, dstdir)
+    measure("PathRebaser.rebase", num, rebase, tree, srcdir, dstdir)
+    measure("PathRebaser.rebase_relative", num, rebase_relative, tree,
+            srcdir, dstdir)
+    measure("PathRebaser.rebase_many", num, rebase_many, tree, srcdir, dstdir)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """ Test the util module. """
-import os.path, stat, codecs
+import os.path, stat, codecs, sys, errno, threading, time
 import hashlib
 
 from srllib import util
@@ -76,6 +76,111 @@ class FileSystemTest(TestCase):
                 os.path.join(dpath, "testdir"), force=True)
 
 
+    def test_remove_dir_workers(self):
+        """ Test removing a directory tree concurrently. """
+        dpath = self.__create_tree()
+        util.chmod(os.path.join(dpath, "dir1"), 0555, recursive=True)
+        util.remove_dir(dpath, force=True, workers=4)
+        self.assertNot(os.path.exists(dpath))
+
+    def test_remove_dir_no_unlinkat(self):
+        """ Test removing a directory tree without fd-relative unlinking. """
+        self._set_attr(util, "_dir_fd_functions", {"unlink": False})
+        dpath = self.__create_tree()
+        util.remove_dir(dpath)
+        self.assertNot(os.path.exists(dpath))
+
+    def test_remove_dir_background(self):
+        """ Test removing directories in the background. """
+        self._set_attr(util, "_reaper", None)
+        trash_root = self._get_tempdir()
+        self._set_attr(util, "_get_mount_point", lambda path: trash_root)
+        try:
+            root = self._get_tempdir()
+            dpath, fpath = (os.path.join(root, "dir"), os.path.join(root,
+                "file"))
+            os.makedirs(os.path.join(dpath, "subdir"))
+            util.create_file(os.path.join(dpath, "subdir", "test"), "Test")
+            util.chmod(os.path.join(dpath, "subdir"), 0555, recursive=True)
+            util.create_file(fpath, "Test")
+            util.remove_dir(dpath, force=True, background=True)
+            # The trash isn't put beside the target
+            self.assertEqual(os.listdir(root), ["file"])
+            util.remove_file_or_dir(fpath, background=True)
+            self.assertEqual(os.listdir(root), [])
+            self.assertEqual(util.wait_for_removals(), [])
+            # The trash directory is removed as well
+            self.assertEqual(os.listdir(trash_root), [])
+
+            # Removal failures are reported when waiting
+            util.configure_background_removal(workers=1,
+                    priority=util.ReapPriority_Normal)
+            os.mkdir(dpath)
+            self._set_attr(util._TreeRemover, "remove", self.__raise_oserror)
+            util.remove_dir(dpath, background=True)
+            self.assertNot(os.path.exists(dpath))
+            self.assertEqual(util.wait_for_removals(), [dpath])
+        finally:
+            # Join the reaper's threads before the original is restored
+            if util._reaper is not None:
+                util._reaper.close()
+
+    def test_remove_dir_background_beside(self):
+        """ Test background removal when the trash could only be put beside
+        the target.
+        """
+        self._set_attr(util, "_reaper", None)
+        root = self._get_tempdir()
+        dpath = os.path.join(root, "dir")
+        os.makedirs(os.path.join(dpath, "subdir"))
+        self._set_attr(util, "_get_mount_point", lambda path: path)
+        self._set_module_attr("tempfile", "tempdir", root)
+        try:
+            # The directory is removed immediately instead
+            util.remove_dir(dpath, background=True)
+            self.assertEqual(os.listdir(root), [])
+            self.assertEqual(util.wait_for_removals(), [])
+        finally:
+            if util._reaper is not None:
+                util._reaper.close()
+
+    def test_remove_dir_background_parent(self):
+        """ Test removing the parent directory while the reaper is still
+        removing a directory.
+        """
+        def remove(remover, path, workers=None):
+            if ".srllib-trash-" in path:
+                started.set()
+                release.wait(10)
+            orig_remove(remover, path, workers=workers)
+
+        self._set_attr(util, "_reaper", None)
+        root, trash_root = self._get_tempdir(), self._get_tempdir()
+        # The mount point is the parent, so the temporary directory is used
+        self._set_attr(util, "_get_mount_point", lambda path: path)
+        self._set_module_attr("tempfile", "tempdir", trash_root)
+        orig_remove = util._TreeRemover.remove
+        self._set_attr(util._TreeRemover, "remove", remove)
+        started, release = threading.Event(), threading.Event()
+        try:
+            dpath = os.path.join(root, "dir")
+            os.makedirs(os.path.join(dpath, "subdir"))
+            util.create_file(os.path.join(dpath, "subdir", "test"), "Test")
+            util.remove_dir(dpath, background=True)
+            started.wait(10)
+            util.remove_dir(root)
+            self.assertNot(os.path.exists(root))
+            release.set()
+            self.assertEqual(util.wait_for_removals(), [])
+            self.assertEqual(os.listdir(trash_root), [])
+        finally:
+            release.set()
+            if util._reaper is not None:
+                util._reaper.close()
+
+    def __raise_oserror(self, *args, **kwds):
+        raise OSError(errno.EIO, "I/O error")
+
     def test_remove_dir_missing(self):
         """ Test removing a missing directory. """
         self.assertRaises(ValueError, util.remove_dir, "nosuchdir")
@@ -201,6 +306,78 @@ class FileSystemTest(TestCase):
         for fname in ("testfile", "oldfile", "newfile"):
             self.assert_(os.path.isfile(os.path.join(dstdir, fname)))
 
+    def test_copy_dir_sync(self):
+        """ Test synchronizing a directory. """
+        def write(relpath, content):
+            fpath = os.path.join(srcdir, relpath)
+            util.create_file(fpath, content)
+            os.utime(fpath, (1000000000, 1000000000))
+
+        srcdir, dstdir = self._get_tempdir(), self._get_tempdir()
+        os.mkdir(os.path.join(srcdir, "dir"))
+        write("same", "Test")
+        write(os.path.join("dir", "changed"), "Test")
+        write("touched", "Test")
+        result = util.copy_dir(srcdir, dstdir, mode=util.CopyDir_Sync)
+        self.assertSortedEqual(result.copied, ["same", os.path.join("dir",
+            "changed"), "touched"])
+        self.assertEqual(result.skipped, [])
+
+        write(os.path.join("dir", "changed"), "Tset")
+        os.utime(os.path.join(srcdir, "touched"), (1100000000, 1100000000))
+        util.create_file(os.path.join(dstdir, "extra"), "Test")
+        util.create_file(os.path.join(dstdir, ".ignored"), "Test")
+        # Without comparing checksums, the changed file looks up to date
+        result = util.copy_dir(srcdir, dstdir, mode=util.CopyDir_Sync)
+        self.assertSortedEqual(result.copied, ["touched"])
+        self.assertSortedEqual(result.skipped, ["same", os.path.join("dir",
+            "changed")])
+        self.assertEqual(result.deleted, [])
+
+        result = util.copy_dir(srcdir, dstdir, mode=util.CopyDir_Sync,
+                sync_checksum=True, sync_delete=True, ignore=[".*"])
+        self.assertEqual(result.copied, [os.path.join("dir", "changed")])
+        self.assertSortedEqual(result.skipped, ["same", "touched"])
+        self.assertEqual(result.deleted, ["extra"])
+        self.assertEqual(util.read_file(os.path.join(dstdir, "dir",
+            "changed")), "Tset")
+        self.assertSortedEqual(os.listdir(dstdir), ["dir", "same", "touched",
+            ".ignored"])
+
+    def test_copy_dir_hardlink(self):
+        """ Test copying a directory as hard links. """
+        srcdir = self.__create_tree()
+        dstdir = os.path.join(self._get_tempdir(), "copy")
+        util.copy_dir(srcdir, dstdir, method=util.CopyMethod_Hardlink)
+        self.assertEqual(util.get_checksum(dstdir), util.get_checksum(srcdir))
+        if hasattr(os, "link"):
+            fpath = os.path.join("dir0", "dir1", "test")
+            self.assertEqual(os.stat(os.path.join(dstdir, fpath)).st_ino,
+                    os.stat(os.path.join(srcdir, fpath)).st_ino)
+        self.assertRaises(ValueError, util.copy_dir, srcdir, dstdir,
+                mode=util.CopyDir_Merge, fs_mode=0600,
+                method=util.CopyMethod_Hardlink)
+        # Copying over the links leaves the source files alone
+        util.copy_dir(srcdir, dstdir, mode=util.CopyDir_Merge)
+        self.assertEqual(util.get_checksum(dstdir), util.get_checksum(srcdir))
+        if hasattr(os, "link"):
+            self.assertNotEqual(os.stat(os.path.join(dstdir, fpath)).st_ino,
+                    os.stat(os.path.join(srcdir, fpath)).st_ino)
+
+    def test_copy_dir_checksum(self):
+        """ Test computing checksums while copying a directory. """
+        srcdir = self.__create_tree()
+        fpaths = [os.path.join(d0, d1, "test") for d0 in ("dir0", "dir1") for
+                d1 in ("", "dir0", "dir1")]
+        for workers in (None, 4):
+            dstdir = os.path.join(self._get_tempdir(), "copy")
+            result = util.copy_dir(srcdir, dstdir, checksum=util.Checksum_Hex,
+                    verify=True, workers=workers)
+            self.assertSortedEqual(result.checksums.keys(), fpaths)
+            for fpath in fpaths:
+                self.assertEqual(result.checksums[fpath], util.get_checksum(
+                    os.path.join(srcdir, fpath)))
+
     def test_copy_dir_writefile(self):
         """ Test passing a custom writefile function to copy_dir. """
         def copyfile(src, dst, callback, **kwds):
@@ -220,6 +397,81 @@ class FileSystemTest(TestCase):
         self.assertEqual(self.__progress, [0, 50.0, 100.0],
             "Wrong progress: %r" % self.__progress)
 
+    def test_copy_dir_workers(self):
+        """ Test copying files concurrently. """
+        def callback(progress):
+            self.assertIs(threading.currentThread(), main_thread)
+            progresses.append(progress)
+
+        main_thread = threading.currentThread()
+        progresses = []
+        srcdir = self.__create_tree()
+        for i in range(20):
+            util.create_file(os.path.join(srcdir, "dir0", "file%d" % (i,)),
+                    "Test" * i)
+        dstdir = os.path.join(self._get_tempdir(), "copy")
+        util.copy_dir(srcdir, dstdir, callback=callback, workers=4)
+        self.assertEqual(util.get_checksum(dstdir), util.get_checksum(srcdir))
+        self.assertEqual(progresses[0], 0)
+        self.assertEqual(progresses[-1], 100.0)
+        self.assertEqual(progresses, sorted(progresses))
+
+    def test_copy_dir_workers_cancel(self):
+        """ Test canceling concurrent copying from the callback. """
+        def copyfile(src, dst, callback, **kwds):
+            started.append(src)
+            while True:
+                # Wait for cancellation, which makes the callback raise
+                callback(50.0)
+                time.sleep(0.01)
+
+        def callback(progress):
+            if progress > 0:
+                raise util.Canceled
+
+        started = []
+        srcdir = self._get_tempdir()
+        for i in range(20):
+            util.create_file(os.path.join(srcdir, "file%d" % (i,)), "Test")
+        nthreads = threading.activeCount()
+        self.assertRaises(util.Canceled, util.copy_dir, srcdir, os.path.join(
+            self._get_tempdir(), "copy"), callback=callback, copyfile=copyfile,
+            workers=4)
+        self.assertEqual(threading.activeCount(), nthreads)
+        self.assertLessOrEqual(len(started), 8)
+
+    def test_copy_dir_progress_background(self):
+        """ Test copying while counting bytes in the background. """
+        srcdir = self.__create_tree()
+        for workers in (None, 4):
+            progresses = []
+            dstdir = os.path.join(self._get_tempdir(), "copy")
+            util.copy_dir(srcdir, dstdir, callback=progresses.append,
+                    workers=workers, progress=util.CopyProgress_Background)
+            self.assertEqual(util.get_checksum(dstdir),
+                    util.get_checksum(srcdir))
+            self.assertEqual(progresses[0], 0)
+            self.assertEqual(progresses[-1], 100.0)
+            self.assertEqual(progresses, sorted(progresses))
+
+    def test_copy_dir_progress_estimate(self):
+        """ Test progress while the total is being estimated. """
+        progresses = []
+        callback = util._CopyDirCallback(None, progresses.append)
+        file_callback = callback.start_file(10)
+        # Copying got ahead of the estimate
+        file_callback(100)
+        callback.end_file(file_callback)
+        # The tree shrinks before the estimate is complete
+        callback.add_to_total(50)
+        file_callback = callback.start_file(30)
+        file_callback(50)
+        callback.end_estimate()
+        file_callback(100)
+        callback.end_file(file_callback)
+        callback.finish()
+        self.assertEqual(progresses, [99.0, 99.0, 99.0, 100.0])
+
     if get_os_name() in OsCollection_Posix:
         def test_copy_dir_symlink(self):
             """ Test copying directory with symlink. """
@@ -265,6 +517,120 @@ class FileSystemTest(TestCase):
         finally: f.close()
         self.assertEqual(txt, "Test")
 
+    def test_copy_file_blocksize(self):
+        """Test copying a file in several blocks."""
+        def callback(progress):
+            progresses.append(progress)
+
+        progresses = []
+        src, dst = self._get_tempfname(content="0123456789"), self._get_tempfname()
+        util.copy_file(src, dst, callback=callback, blocksize=4)
+        self.assertEqual(util.read_file(dst), "0123456789")
+        self.assertEqual(progresses, [40, 80, 100])
+        self.assertRaises(ValueError, util.copy_file, src, dst, blocksize=0)
+
+    def test_copy_file_kernel_fallback(self):
+        """Test falling back from in-kernel copying."""
+        def copy_partial(srcfd, dstfd, offset, count):
+            if offset >= 4:
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            return os.write(dstfd, os.read(srcfd, count))
+
+        def copy_broken(srcfd, dstfd, offset, count):
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+        progresses = []
+        src, dst = self._get_tempfname(content="0123456789"), self._get_tempfname()
+        self._set_attr(util, "_kernel_copiers", [copy_partial])
+        util.copy_file(src, dst, callback=progresses.append, blocksize=4)
+        self.assertEqual(util.read_file(dst), "0123456789")
+        self.assertEqual(progresses, [40, 80, 100])
+
+        # Errors other than lacking support are raised
+        self._set_attr(util, "_kernel_copiers", [copy_broken])
+        self.assertRaises(OSError, util.copy_file, src, dst)
+
+    def test_copy_file_method(self):
+        """Test cloning and hard linking files."""
+        def link_fail(srcpath, dstpath):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        src = self._get_tempfname(content="Test")
+        for method in (util.CopyMethod_Reflink, util.CopyMethod_Hardlink):
+            dst = self._get_tempfname(content="Old content")
+            progresses = []
+            util.copy_file(src, dst, callback=progresses.append,
+                    method=method)
+            self.assertEqual(util.read_file(dst), "Test")
+            self.assertEqual(progresses[-1], 100)
+        if hasattr(os, "link"):
+            self.assertEqual(os.stat(dst).st_ino, os.stat(src).st_ino)
+
+            # Linking across filesystems falls back to copying
+            dst = self._get_tempfname()
+            self._set_attr(os, "link", link_fail)
+            util.copy_file(src, dst, method=util.CopyMethod_Hardlink)
+            self.assertEqual(util.read_file(dst), "Test")
+            self.assertNotEqual(os.stat(dst).st_ino, os.stat(src).st_ino)
+
+        self.assertRaises(ValueError, util.copy_file, src, dst,
+                fs_mode=0600, method=util.CopyMethod_Hardlink)
+
+    def test_copy_file_over_link(self):
+        """Test copying onto a hard link to the source file."""
+        src, dst = self._get_tempfname(content="Test"), self._get_tempfname()
+        util.copy_file(src, dst, method=util.CopyMethod_Hardlink)
+        # The link must be replaced, rather than truncating the source
+        util.copy_file(src, dst)
+        self.assertEqual(util.read_file(src), "Test")
+        self.assertEqual(util.read_file(dst), "Test")
+        if hasattr(os, "link"):
+            self.assertNotEqual(os.stat(dst).st_ino, os.stat(src).st_ino)
+        self.assertRaises(ValueError, util.copy_file, src, src)
+        self.assertEqual(util.read_file(src), "Test")
+
+    def test_copy_file_checksum(self):
+        """Test computing the checksum while copying."""
+        def copy_corrupt(src, dst, offset, end, buf, progress, hash_obj=None):
+            data = src.read()
+            hash_obj.update(data)
+            dst.write(data[::-1])
+            return len(data)
+
+        src, dst = self._get_tempfname(content="Test"), self._get_tempfname()
+        for format in (util.Checksum_Hex, util.Checksum_Binary):
+            self.assertEqual(util.copy_file(src, dst, checksum=format,
+                verify=True), util.get_checksum(src, format=format))
+        self.assertEqual(util.copy_file(src, dst), None)
+        self.assertRaises(ValueError, util.copy_file, src, dst, checksum=-1)
+
+        self._set_attr(util, "_copy_data", copy_corrupt)
+        util.copy_file(src, dst, checksum=util.Checksum_Hex)
+        self.assertRaises(util.ChecksumMismatch, util.copy_file, src, dst,
+                checksum=util.Checksum_Hex, verify=True)
+
+    def test_copy_file_sparse(self):
+        """Test copying a sparse file."""
+        src, dst = self._get_tempfname(), self._get_tempfname()
+        f = file(src, "wb")
+        try:
+            for offset in (1024 * 1024, 3 * 1024 * 1024):
+                f.seek(offset)
+                f.write("Test")
+            f.truncate(5 * 1024 * 1024)
+        finally: f.close()
+
+        progresses = []
+        self.assertEqual(util.copy_file(src, dst, callback=progresses.append,
+            blocksize=64 * 1024, checksum=util.Checksum_Hex),
+            util.get_checksum(src))
+        self.assertEqual(util.read_file(dst), util.read_file(src))
+        self.assertEqual(progresses[-1], 100)
+        self.assertEqual(progresses, sorted(progresses))
+        st = os.stat(src)
+        if util._is_sparse(st):
+            self.assertEqual(os.stat(dst).st_blocks, st.st_blocks)
+
     def test_copy_file_missing(self):
         src, dst = self._get_tempfname(), self._get_tempfname()
         os.remove(src)
@@ -341,6 +707,45 @@ class FileSystemTest(TestCase):
             self.assertEqual(util.get_file_permissions(os.path.join(dpath, e)),
                     mode)
 
+    def test_chmod_workers(self):
+        """ Test recursive chmod with threads, and without fd-relative
+        operations.
+        """
+        dpath = self.__create_tree()
+        for workers, chmodat in ((4, None), (None, False)):
+            if chmodat is not None:
+                self._set_attr(util, "_dir_fd_functions", {"chmod": chmodat})
+            # Directories must be made traversable temporarily
+            util.chmod(dpath, 0444, recursive=True, workers=workers)
+            self.assertEqual(util.get_file_permissions(dpath), 0444)
+            util.chmod(dpath, 0755, recursive=True, workers=workers)
+            # The contents of nested directories are reached
+            self.assertEqual(util.get_file_permissions(os.path.join(dpath,
+                "dir1", "dir0", "test")), 0755)
+            paths = [dpath]
+            for dpath1, dnames, fnames in util.walkdir(dpath):
+                paths += [os.path.join(dpath1, n) for n in dnames + fnames]
+            self.assertEqual(len(paths), 13)
+            for path in paths:
+                self.assertEqual(util.get_file_permissions(path), 0755)
+
+    @only_posix
+    def test_chmod_symlinks(self):
+        """ Test that recursive chmod leaves symlink targets alone. """
+        dpath, outside = self._get_tempdir(), self._get_tempdir()
+        fpath = util.create_file(os.path.join(outside, "file"))
+        os.chmod(outside, 0755)
+        os.chmod(fpath, 0644)
+        os.symlink(outside, os.path.join(dpath, "dirlink"))
+        os.symlink(fpath, os.path.join(dpath, "filelink"))
+        util.create_file(os.path.join(dpath, "file"))
+        for workers in (None, 4):
+            util.chmod(dpath, 0700, recursive=True, workers=workers)
+            self.assertEqual(util.get_file_permissions(os.path.join(dpath,
+                "file")), 0700)
+            self.assertEqual(util.get_file_permissions(outside), 0755)
+            self.assertEqual(util.get_file_permissions(fpath), 0644)
+
     def test_walkdir(self):
         entered = []
         root = self.__create_dir()
@@ -358,6 +763,126 @@ class FileSystemTest(TestCase):
             entered.append(dpath)
         self.assertEqual(entered, [root, os.path.join(root, "testdir")])
 
+    def test_walkdir_bottomup(self):
+        """Test traversing bottom-up."""
+        root = self.__create_dir()
+        os.mkdir(os.path.join(root, "testdir", "subdir"))
+        os.mkdir(os.path.join(root, "testdir2"))
+        entered = [dpath for dpath, dnames, fnames in util.walkdir(root,
+            topdown=False, sort=True)]
+        self.assertEqual(entered, [os.path.join(root, "testdir", "subdir"),
+            os.path.join(root, "testdir"), os.path.join(root, "testdir2"),
+            root])
+
+    def test_walkdir_deep(self):
+        """Test traversing a tree deeper than the recursion limit."""
+        root = dpath = self._get_tempdir()
+        for i in range(200):
+            dpath = os.path.join(dpath, "d")
+            os.mkdir(dpath)
+        reclimit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100)
+        try:
+            for topdown in (True, False):
+                self.assertEqual(len(list(util.walkdir(root, topdown=topdown))),
+                        201)
+        finally:
+            sys.setrecursionlimit(reclimit)
+
+    def test_walkdir_workers(self):
+        """Test traversing with a pool of worker threads."""
+        root = self.__create_tree()
+        for topdown in (True, False):
+            ref = list(util.walkdir(root, topdown=topdown, sort=True))
+            self.assertEqual(list(util.walkdir(root, topdown=topdown, sort=True,
+                workers=4)), ref)
+
+            # In unordered mode, only parents and subdirectories are ordered
+            # relative to each other
+            walked = list(util.walkdir(root, topdown=topdown, workers=4))
+            self.assertSortedEqual([(dpath, sorted(dnames), sorted(fnames)) for
+                dpath, dnames, fnames in walked], ref)
+            entered = [dpath for dpath, dnames, fnames in walked]
+            for i, dpath in enumerate(entered):
+                if dpath == root:
+                    continue
+                parent_idx = entered.index(os.path.dirname(dpath))
+                if topdown:
+                    self.assertLessThan(parent_idx, i)
+                else:
+                    self.assertGreaterThan(parent_idx, i)
+
+    def test_walkdir_workers_prune(self):
+        """Test excluding directories from traversal with worker threads."""
+        root = self.__create_tree()
+        for sort in (True, False):
+            entered = []
+            for dpath, dnames, fnames in util.walkdir(root, sort=sort,
+                    workers=4):
+                entered.append(dpath)
+                if "dir1" in dnames:
+                    dnames.remove("dir1")
+            self.assertEqual(len(entered), 3)
+
+    def test_workers(self):
+        """Test tree operations with worker threads."""
+        srcdir = self.__create_tree()
+        dstdir = os.path.join(self._get_tempdir(), "copy")
+        util.copy_dir(srcdir, dstdir, workers=4)
+        self.assertEqual(util.get_checksum(dstdir, workers=4),
+                util.get_checksum(srcdir))
+        util.chmod(dstdir, 0500, recursive=True, workers=4)
+        self.assertEqual(util.get_file_permissions(os.path.join(dstdir, "dir1",
+            "dir0")), 0500)
+        util.remove_dir(dstdir, force=True, workers=4)
+        self.assertNot(os.path.exists(dstdir))
+
+    def test_walkdir_prune(self):
+        """Test excluding directories from traversal in topdown mode."""
+        root = self.__create_dir()
+        entered = []
+        for dpath, dnames, fnames in util.walkdir(root):
+            entered.append(dpath)
+            dnames.remove("testdir")
+        self.assertEqual(entered, [root])
+
+    def test_walkdir_entries(self):
+        """Test walkdir yielding directory entries."""
+        def fail(path):
+            raise AssertionError("Redundant system call for '%s'" % (path,))
+
+        root = self.__create_dir()
+        os.mkdir(os.path.join(root, "testdir2"))
+        if get_os_name() in OsCollection_Posix:
+            os.symlink("nosuchfile", os.path.join(root, "broken"))
+        # Directory entries should know their own types
+        self._set_attr(os.path, "isdir", fail)
+        self._set_attr(os.path, "islink", fail)
+        walked = [(dpath, [(e.name, e.path) for e in dentries],
+            [e.name for e in fentries]) for dpath, dentries, fentries in
+            util.walkdir(root, sort=True, entries=True)]
+        fnames = ["test"]
+        if get_os_name() in OsCollection_Posix:
+            fnames.insert(0, "broken")
+        self.assertEqual(walked, [
+            (root, [("testdir", os.path.join(root, "testdir")), ("testdir2",
+                os.path.join(root, "testdir2"))], fnames),
+            (os.path.join(root, "testdir"), [], ["test"]),
+            (os.path.join(root, "testdir2"), [], []),
+            ])
+
+        for dpath, dentries, fentries in util.walkdir(root, sort=True,
+                entries=True):
+            for entry in fentries:
+                if entry.name == "test":
+                    self.assertEqual(entry.stat().st_size, 4)
+                    self.assertNot(entry.is_symlink())
+                else:
+                    self.assert_(entry.is_symlink())
+                    self.assertNot(entry.is_dir())
+                    self.assertRaises(OSError, entry.stat)
+            break
+
     def test_remove_file(self):
         dpath = self._get_tempdir()
         fpath = util.create_file(os.path.join(dpath, "test"))
@@ -462,6 +987,29 @@ class FileSystemTest(TestCase):
                     r"C:\thatdir\file")
 
 
+    def test_path_rebaser(self):
+        """ Test rebasing paths with PathRebaser. """
+        rebaser = util.PathRebaser(os.path.join("dir", ""), os.path.join(
+            "new", "root", os.pardir))
+        self.assertEqual(rebaser.new_root, "new")
+        self.assertEqual(rebaser.rebase(os.path.join("dir", "a", "b")),
+                os.path.join("new", "a", "b"))
+        # Paths are normalized, unless beneath the root as given
+        self.assertEqual(rebaser.rebase(os.path.join(os.curdir, "dir", "a")),
+                os.path.join("new", "a"))
+        self.assertEqual(rebaser.rebase("dir"), "new")
+        self.assertRaises(ValueError, rebaser.rebase, os.path.join("dirs",
+            "a"))
+        self.assertEqual(rebaser.rebase_many([os.path.join("dir", "a"),
+            os.path.join("dir", "b", "c")]), [os.path.join("new", "a"),
+                os.path.join("new", "b", "c")])
+        self.assertEqual(rebaser.rebase_many([os.path.join("dir", "a"), "dir"]),
+                [os.path.join("new", "a"), "new"])
+        self.assertRaises(ValueError, rebaser.rebase_many, [os.path.join("dir",
+            "a"), "other"])
+        self.assertEqual(rebaser.rebase_relative(os.path.join("a", "b")),
+                os.path.join("new", "a", "b"))
+
     def test_resolve_path(self):
         """ Test resolving path to executable. """
         self.assertEquals(os.path.splitext(os.path.basename(
@@ -478,6 +1026,34 @@ class FileSystemTest(TestCase):
         self.assertRaises(_srlerror.NotFound, util.resolve_path,
                 "There is no such executable.")
 
+    @only_posix
+    def test_resolve_path_index(self):
+        """ Test that resolve_path notices changes to PATH and its directories.
+        """
+        self._set_attr(util, "_PathIndexCheckInterval", 0)
+        dpath0, dpath1 = self._get_tempdir(), self._get_tempdir()
+        path_env = os.environ.get("PATH", "")
+        os.environ["PATH"] = os.pathsep.join([dpath0, path_env])
+        try:
+            fpath = util.create_file(os.path.join(dpath0, "srltest"))
+            # Not executable
+            self.assertRaises(_srlerror.NotFound, util.resolve_path,
+                    "srltest")
+            util.chmod(fpath, 0755)
+            self.assertEqual(util.resolve_path("srltest"), fpath)
+            self.assertEqual(util.resolve_paths(["srltest", "python"]),
+                    [fpath, util.resolve_path("python")])
+            os.remove(fpath)
+            self.assertRaises(_srlerror.NotFound, util.resolve_path,
+                    "srltest")
+
+            fpath = util.create_file(os.path.join(dpath1, "srltest"))
+            util.chmod(fpath, 0755)
+            os.environ["PATH"] = os.pathsep.join([dpath0, dpath1])
+            self.assertEqual(util.resolve_path("srltest"), fpath)
+        finally:
+            os.environ["PATH"] = path_env
+
     def test_resolve_path_badname(self):
         """ resolve_path should not accept a pathname with directory components.
         """
@@ -513,6 +1089,152 @@ class FileSystemTest(TestCase):
         util.chmod(subdir0, 0)
         self.assertEqual(util.compare_dirs(dpath0, dpath1), (["subdir"], []))
 
+    def test_diff_dirs(self):
+        """ Test finding the differences between two directory trees. """
+        dpath0, dpath1 = self._get_tempdir(), self._get_tempdir()
+        for dpath in (dpath0, dpath1):
+            os.makedirs(os.path.join(dpath, "dir", "subdir"))
+            util.create_file(os.path.join(dpath, "dir", "subdir", "same"),
+                    "Test")
+        util.create_file(os.path.join(dpath0, "content"), "Test")
+        util.create_file(os.path.join(dpath1, "content"), "Tset")
+        util.create_file(os.path.join(dpath0, "size"), "Test")
+        util.create_file(os.path.join(dpath1, "size"), "Tst")
+        util.create_file(os.path.join(dpath0, "type"), "Test")
+        os.mkdir(os.path.join(dpath1, "type"))
+        util.create_file(os.path.join(dpath0, "dir", "removed"), "Test")
+        util.create_file(os.path.join(dpath1, "added"), "Test")
+
+        diff = util.diff_dirs(dpath0, dpath1)
+        self.assertEqual(diff.added, ["added"])
+        self.assertEqual(diff.removed, [os.path.join("dir", "removed")])
+        self.assertEqual(diff.type_changed, ["type"])
+        self.assertEqual(diff.metadata_changed, ["size"])
+        self.assertEqual(diff.content_changed, [])
+        self.assertEqual(diff.errors, [])
+        self.assert_(diff)
+        for workers in (None, 4):
+            self.assertEqual(util.diff_dirs(dpath0, dpath1, shallow=False,
+                workers=workers).content_changed, ["content"])
+        self.assertNot(util.diff_dirs(dpath0, dpath0, shallow=False))
+        for workers in (None, 4):
+            self.assertEqual(util.compare_dirs(dpath0, dpath1, False,
+                workers=workers), (["content", "size", "type"], ["added",
+                    os.path.join("dir", "removed")]))
+
+    def test_compare_dirs_mismatched_dir(self):
+        """ Test that the contents of mismatched directories aren't compared.
+        """
+        def filecheck(path0, path1):
+            compared.append(path0)
+            return True
+
+        dpath0, dpath1 = self._get_tempdir(), self._get_tempdir()
+        for dpath in (dpath0, dpath1):
+            os.makedirs(os.path.join(dpath, "dir", "subdir"))
+            util.create_file(os.path.join(dpath, "dir", "subdir", "file"),
+                    "Test")
+        util.create_file(os.path.join(dpath1, "dir", "added"))
+        os.chmod(os.path.join(dpath1, "dir"), 0700)
+        os.chmod(os.path.join(dpath0, "dir"), 0750)
+
+        compared = []
+        self.assertEqual(util.compare_dirs(dpath0, dpath1, False,
+            filecheck_func=filecheck), (["dir"], []))
+        self.assertEqual(compared, [])
+        diff = util.diff_dirs(dpath0, dpath1, shallow=False,
+                filecheck_func=filecheck)
+        self.assertEqual(diff.added, [os.path.join("dir", "added")])
+        self.assertEqual(len(compared), 1)
+        self.assertEqual(util.diff_dirs(dpath0, dpath1,
+            descend_mismatched=False).added, [])
+
+    def test_compare_snapshot(self):
+        """ Test comparing a directory tree against a snapshot. """
+        dpath = self._get_tempdir()
+        os.makedirs(os.path.join(dpath, "dir", "subdir"))
+        os.makedirs(os.path.join(dpath, "removed", "subdir"))
+        for fname in ("content", "size", "type", os.path.join("dir", "a.txt"),
+                os.path.join("dir", "subdir", "same")):
+            util.create_file(os.path.join(dpath, fname), "Test")
+        fpath = self._get_tempfname()
+        self.assertEqual(util.snapshot_dir(dpath, fpath, checksums=True), 9)
+        self.assertNot(util.compare_snapshot(fpath, dpath, shallow=False))
+
+        util.create_file(os.path.join(dpath, "content"), "Tset")
+        util.create_file(os.path.join(dpath, "size"), "Tst")
+        os.remove(os.path.join(dpath, "type"))
+        os.mkdir(os.path.join(dpath, "type"))
+        util.remove_dir(os.path.join(dpath, "removed"))
+        os.makedirs(os.path.join(dpath, "added", "subdir"))
+
+        diff = util.compare_snapshot(fpath, dpath, shallow=False)
+        self.assertEqual(diff.added, ["added"])
+        self.assertEqual(diff.removed, ["removed"])
+        self.assertEqual(diff.type_changed, ["type"])
+        self.assertEqual(diff.metadata_changed, ["size"])
+        self.assertEqual(diff.content_changed, ["content"])
+        self.assertEqual(diff.errors, [])
+        self.assertEqual(util.compare_snapshot(fpath, dpath).content_changed,
+                [])
+
+        # Without checksums, contents can't be compared
+        util.snapshot_dir(dpath, fpath)
+        self.assertNot(util.compare_snapshot(fpath, dpath))
+        self.assertRaises(ValueError, util.compare_snapshot, fpath, dpath,
+                shallow=False)
+        self.assertRaises(util.InvalidSnapshot, util.compare_snapshot,
+                self._get_tempfname(content="Test"), dpath)
+
+    @only_posix
+    def test_compare_snapshot_symlink(self):
+        """ Test comparing symlinks against a snapshot. """
+        dpath = self._get_tempdir()
+        util.create_file(os.path.join(dpath, "content"), "Test")
+        os.symlink("content", os.path.join(dpath, "link"))
+        fpath = self._get_tempfname()
+        self.assertEqual(util.snapshot_dir(dpath, fpath, checksums=True), 2)
+        self.assertNot(util.compare_snapshot(fpath, dpath, shallow=False))
+
+        # A target of the same length, so that only the content differs
+        os.remove(os.path.join(dpath, "link"))
+        os.symlink("contenu", os.path.join(dpath, "link"))
+        diff = util.compare_snapshot(fpath, dpath, shallow=False)
+        self.assertEqual(diff.content_changed, ["link"])
+        self.assertEqual(diff.metadata_changed, [])
+        self.assertNot(util.compare_snapshot(fpath, dpath))
+
+    def test_compare_dirs_workers(self):
+        """ Test comparing file contents in parallel. """
+        dpath0 = self.__create_tree()
+        dpath1 = os.path.join(self._get_tempdir(), "copy")
+        util.copy_dir(dpath0, dpath1)
+        self.assertEqual(util.compare_dirs(dpath0, dpath1, False, workers=4),
+                ([], []))
+        fpath = os.path.join("dir1", "dir0", "test")
+        util.create_file(os.path.join(dpath1, fpath), util.read_file(
+            os.path.join(dpath0, fpath))[::-1])
+        self.assertEqual(util.compare_dirs(dpath0, dpath1, False, workers=4),
+                ([fpath], []))
+
+    def test_compare_files(self):
+        """ Test comparing file contents block by block. """
+        content = "".join([chr(i % 256) for i in range(1000)])
+        fpath0 = self._get_tempfname(content=content)
+        self.assert_(util.compare_files(fpath0, fpath0))
+        self.assert_(util.compare_files(self._get_tempfname(),
+            self._get_tempfname()))
+        self.assertNot(util.compare_files(fpath0, self._get_tempfname(
+            content=content[:-1])))
+        for blocksize in (16, 1000, 4096):
+            # Differing in the first, a middle and the last block
+            for offset in (0, 500, 999):
+                other = content[:offset] + "x" + content[offset + 1:]
+                self.assertNot(util.compare_files(fpath0, self._get_tempfname(
+                    content=other), blocksize=blocksize))
+            self.assert_(util.compare_files(fpath0, self._get_tempfname(
+                content=content), blocksize=blocksize))
+
     def test_clean_path(self):
         self.assertEqual(util.clean_path(os.path.join("dir", "..", "file")),
                 os.path.join(os.path.abspath("file")))
@@ -528,6 +1250,16 @@ class FileSystemTest(TestCase):
         util.create_file(os.path.join(dpath, "testdir", "test"), "Test")
         return dpath
 
+    def __create_tree(self):
+        """ Create directory with two levels of subdirectories. """
+        dpath = self._get_tempdir()
+        for dname0 in ("dir0", "dir1"):
+            for dname1 in ("", "dir0", "dir1"):
+                subpath = os.path.join(dpath, dname0, dname1)
+                os.mkdir(subpath)
+                util.create_file(os.path.join(subpath, "test"), subpath)
+        return dpath
+
     def __create_tempfile(self, *args, **kwds):
         fpath = util.create_tempfile(*args, **kwds)
         self._tempfiles.append(fpath)
@@ -554,6 +1286,50 @@ class VariousTest(TestCase):
         self.assertRaises(_srlerror.Canceled, util.get_checksum, path, callback=
             callback)
 
+    def test_get_checksum_workers(self):
+        """Test get_checksum with a pool of worker threads."""
+        dpath = self._get_tempdir()
+        os.mkdir(os.path.join(dpath, "subdir"))
+        for i in range(10):
+            util.create_file(os.path.join(dpath, "test%d" % (i,)), "Test%d" % (i,))
+            util.create_file(os.path.join(dpath, "subdir", "test%d" % (i,)),
+                    "Test" * i)
+        chksum = util.get_checksum(dpath)
+        self.assertEqual(util.get_checksum(dpath, workers=4), chksum)
+        # Make sure that files too large to be read ahead are also accounted
+        # for correctly
+        self._set_attr(util, "_ReadAheadMax", 16)
+        self.assertEqual(util.get_checksum(dpath, workers=4), chksum)
+
+    def test_get_checksum_workers_cancel(self):
+        """Test canceling checksum calculation with worker threads."""
+        def callback():
+            raise _srlerror.Canceled
+
+        dpath = self._get_tempdir()
+        for i in range(10):
+            util.create_file(os.path.join(dpath, "test%d" % (i,)), "Test")
+        self.assertRaises(_srlerror.Canceled, util.get_checksum, dpath,
+                callback=callback, workers=4)
+
+    def test_get_checksum_blocksize(self):
+        """Test get_checksum with different block sizes, and memory mapping."""
+        text = "Test" * 1000
+        ref_hash = hashlib.sha1(text).hexdigest()
+        path = util.create_file(self._get_tempfname(), text, binary=True)
+        for blocksize in (1, 7, 4000, util.BlockSize_Default):
+            self.assertEqual(util.get_checksum(path, blocksize=blocksize),
+                    ref_hash)
+            self.assertEqual(util.get_checksum(path, blocksize=blocksize,
+                mmap_threshold=1), ref_hash)
+        self.assertRaises(ValueError, util.get_checksum, path, blocksize=0)
+
+    def test_get_checksum_mmap_empty(self):
+        """Test get_checksum with memory mapping of empty file."""
+        path = self._get_tempfname()
+        self.assertEqual(util.get_checksum(path, mmap_threshold=0),
+                hashlib.sha1().hexdigest())
+
     def test_get_checksum_invalid_format(self):
         """ Pass invalid format to get_checksum. """
         self.assertRaises(ValueError, util.get_checksum, "somepath", -1)
@@ -618,6 +1394,287 @@ class VariousTest(TestCase):
         self._set_module_attr("platform", "uname", uname)
         self.assertEqual(util.get_os(), (Os_Windows, "6.1.6000"))
 
+    def test_get_os_cached(self):
+        """Make sure that the OS is only identified once."""
+        calls = []
+        def uname():
+            calls.append(None)
+            return "Linux", "host", "2.6.32", "", "", ""
+
+        self._set_module_attr("platform", "uname", uname)
+        for i in range(2):
+            self.assertEqual(util.get_os(), (Os_Linux, "2.6.32"))
+        self.assertEqual(len(calls), 1)
+
+    def test_lazy_imports(self):
+        """Make sure that rarely used modules aren't imported with srllib.util.
+        """
+        import subprocess
+        modules = ["Queue", "mmap", "marshal", "tempfile", "shutil", "platform"]
+        script = "import sys; import srllib.util; print [m for m in %r if " \
+                "m in sys.modules]" % (modules,)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(
+            util.__file__)))
+        proc = subprocess.Popen([sys.executable, "-c", script], cwd=root,
+                stdout=subprocess.PIPE)
+        self.assertEqual(proc.communicate()[0].strip(), "[]")
+
+
+class ChecksumCacheTest(TestCase):
+    """ Test ChecksumCache. """
+    def test_get_checksum(self):
+        """Test get_checksum with cache."""
+        cache = util.ChecksumCache(self._get_tempfname())
+        fpath = self.__create_file("Test1")
+        chksum = util.get_checksum(fpath)
+        self.assertEqual(util.get_checksum(fpath, cache=cache), chksum)
+        self.assertEqual(len(cache), 1)
+
+        # Change content without changing metadata, so the stale checksum
+        # proves that the file wasn't read again
+        self.__create_file("Test2", fpath)
+        self.assertEqual(util.get_checksum(fpath, cache=cache), chksum)
+        self.assertEqual(util.get_checksum(fpath, format=util.Checksum_Binary,
+            cache=cache), chksum.decode("hex"))
+        # Now make the metadata reflect the change
+        os.utime(fpath, None)
+        self.assertNotEqual(util.get_checksum(fpath, cache=cache), chksum)
+
+    def test_get_checksum_dir(self):
+        """Test get_checksum on directory with cache."""
+        cache = util.ChecksumCache(self._get_tempfname())
+        dpath = self._get_tempdir()
+        os.mkdir(os.path.join(dpath, "subdir"))
+        self.__create_file("Test1", os.path.join(dpath, "test"))
+        fpath1 = self.__create_file("Test2", os.path.join(dpath, "subdir",
+            "test"))
+        chksum = util.get_checksum(dpath, cache=cache)
+        self.assertEqual(chksum, util.get_checksum(dpath))
+        self.__create_file("Test3", fpath1)
+        self.assertEqual(util.get_checksum(dpath, cache=cache), chksum)
+        os.utime(fpath1, None)
+        self.assertEqual(util.get_checksum(dpath, cache=cache),
+                util.get_checksum(dpath))
+
+    def test_racy(self):
+        """Recently modified files shouldn't be cached."""
+        cache = util.ChecksumCache(self._get_tempfname())
+        fpath = util.create_file(self._get_tempfname(), "Test")
+        util.get_checksum(fpath, cache=cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_save(self):
+        """Test saving and loading cache."""
+        cachepath = self._get_tempfname()
+        os.remove(cachepath)
+        cache = util.ChecksumCache(cachepath)
+        fpath = self.__create_file("Test")
+        chksum = util.get_checksum(fpath, cache=cache)
+        cache.save()
+
+        cache = util.ChecksumCache(cachepath)
+        self.assertEqual(len(cache), 1)
+        self.__create_file("Tust", fpath)
+        self.assertEqual(util.get_checksum(fpath, cache=cache), chksum)
+
+    def test_save_invalid(self):
+        """Test loading an invalid cache file."""
+        cachepath = self._get_tempfname(content="Not a cache")
+        self.assertEqual(len(util.ChecksumCache(cachepath)), 0)
+
+    def test_lru(self):
+        """Test evicting least recently used entries."""
+        cache = util.ChecksumCache(self._get_tempfname(), max_entries=2)
+        cache.store(0, "0")
+        cache.store(1, "1")
+        self.assertEqual(cache.lookup(0), "0")
+        cache.store(2, "2")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.lookup(1), None)
+        self.assertEqual(cache.lookup(0), "0")
+        self.assertEqual(cache.lookup(2), "2")
+
+    def test_compare_dirs(self):
+        """Test compare_dirs with cache."""
+        cache = util.ChecksumCache(self._get_tempfname())
+        dpath0, dpath1 = self._get_tempdir(), self._get_tempdir()
+        self.__create_file("Test", os.path.join(dpath0, "test"))
+        self.__create_file("Test", os.path.join(dpath1, "test"))
+        self.assertEqual(util.compare_dirs(dpath0, dpath1, shallow=False,
+            cache=cache), ([], []))
+        self.assertEqual(len(cache), 2)
+
+    def __create_file(self, content, fpath=None):
+        """Create file with modification time in the past, so that it is
+        eligible for caching.
+        """
+        if fpath is None:
+            fpath = self._get_tempfname()
+        util.create_file(fpath, content)
+        os.utime(fpath, (1000000000, 1000000000))
+        return fpath
+
+class ChecksumTreeTest(TestCase):
+    """ Test get_checksum_tree. """
+    def test_get_checksum_tree(self):
+        dpath = self.__create_tree()
+        tree = util.get_checksum_tree(dpath)
+        self.assertEqual(tree.hexdigest(), util.get_checksum_tree(dpath
+            ).hexdigest())
+        self.assertEqual(tree.get_digest("test"), util.get_checksum(
+            os.path.join(dpath, "test"), util.Checksum_Binary))
+        self.assertEqual([relpath for relpath, digest in tree.iter_dirs()],
+                ["", "subdir0", "subdir1"])
+        self.assertRaises(KeyError, tree.get_digest, "nosuchfile")
+
+        util.create_file(os.path.join(dpath, "subdir0", "test"), "Tust")
+        tree1 = util.get_checksum_tree(dpath)
+        self.assertNotEqual(tree1.digest, tree.digest)
+        self.assertNotEqual(tree1.get_digest("subdir0"), tree.get_digest(
+            "subdir0"))
+        self.assertEqual(tree1.get_digest("subdir1"), tree.get_digest(
+            "subdir1"))
+
+    def test_previous(self):
+        """Test reusing checksums from a previous tree."""
+        dpath = self.__create_tree()
+        tree = util.get_checksum_tree(dpath)
+        # Change content without changing metadata, so the stale checksum
+        # proves that the file wasn't read again
+        fpath = os.path.join(dpath, "subdir0", "test")
+        util.create_file(fpath, "Tust")
+        os.utime(fpath, (1000000000, 1000000000))
+        tree1 = util.get_checksum_tree(dpath, previous=tree)
+        self.assertEqual(tree1.digest, tree.digest)
+
+        os.utime(fpath, None)
+        tree1 = util.get_checksum_tree(dpath, previous=tree)
+        self.assertEqual(tree1.digest, util.get_checksum_tree(dpath).digest)
+        self.assertNotEqual(tree1.digest, tree.digest)
+
+    def test_diff(self):
+        """Test diffing two trees."""
+        dpath = self.__create_tree()
+        tree0 = util.get_checksum_tree(dpath)
+        util.create_file(os.path.join(dpath, "subdir0", "test"), "Tust")
+        util.remove_dir(os.path.join(dpath, "subdir1"))
+        util.create_file(os.path.join(dpath, "new"))
+        tree1 = util.get_checksum_tree(dpath)
+        self.assertEqual(tree0.diff(tree1), ["new", os.path.join("subdir0",
+            "test"), "subdir1"])
+        self.assertEqual(tree0.diff(tree0), [])
+
+    def __create_tree(self):
+        dpath = self._get_tempdir()
+        util.create_file(os.path.join(dpath, "test"), "Test")
+        for dname in ("subdir0", "subdir1"):
+            os.mkdir(os.path.join(dpath, dname))
+            fpath = util.create_file(os.path.join(dpath, dname, "test"), "Test")
+            os.utime(fpath, (1000000000, 1000000000))
+        return dpath
+
+class ManifestTest(TestCase):
+    """ Test manifest functionality. """
+    def test_iter_manifest(self):
+        dpath = self.__create_tree()
+        for inflight in (1, 4):
+            entries = list(util.iter_manifest(dpath, inflight=inflight))
+            self.assertEqual([e.path for e in entries], ["test0", "test1",
+                os.path.join("subdir", "test")])
+            fpath = os.path.join(dpath, "test1")
+            st = os.stat(fpath)
+            self.assertEqual(entries[1], ("test1", st.st_size,
+                st.st_mtime, util.get_checksum(fpath, util.Checksum_Binary)))
+
+    def test_iter_manifest_algorithm(self):
+        """Test producing manifest with a different hash algorithm."""
+        dpath = self.__create_tree()
+        entries = list(util.iter_manifest(dpath, algorithm="md5"))
+        self.assertEqual(entries[0].digest, hashlib.md5("Test0").digest())
+        self.assertRaises(ValueError, util.iter_manifest, dpath,
+                algorithm="nosuchalgorithm")
+
+    def test_iter_manifest_cancel(self):
+        """Test canceling manifest production."""
+        def callback():
+            raise _srlerror.Canceled
+
+        dpath = self.__create_tree()
+        self.assertRaises(_srlerror.Canceled, list, util.iter_manifest(dpath,
+            callback=callback))
+
+    def test_write_read(self):
+        """Test writing and reading back manifest."""
+        dpath, fpath = self.__create_tree(), self._get_tempfname()
+        entries = list(util.iter_manifest(dpath, algorithm="sha256"))
+        self.assertEqual(util.write_manifest(util.iter_manifest(dpath,
+            algorithm="sha256"), fpath, algorithm="sha256"), 3)
+        self.assertEqual(util.get_manifest_algorithm(fpath), "sha256")
+        self.assertEqual(list(util.read_manifest(fpath)), entries)
+
+        self.assertRaises(ValueError, util.write_manifest, entries, fpath)
+        util.create_file(fpath, "Not a manifest")
+        self.assertRaises(util.InvalidManifest, list, util.read_manifest(
+            fpath))
+
+    def test_verify_manifest(self):
+        """Test verifying directory tree against manifest."""
+        dpath, fpath = self.__create_tree(), self._get_tempfname()
+        util.write_manifest(util.iter_manifest(dpath), fpath)
+        self.assertEqual(util.verify_manifest(dpath, fpath), ([], []))
+        util.create_file(os.path.join(dpath, "test0"), "Tust0")
+        util.create_file(os.path.join(dpath, "test1"), "Test11")
+        os.remove(os.path.join(dpath, "subdir", "test"))
+        self.assertEqual(util.verify_manifest(dpath, fpath), (["test0",
+            "test1"], [os.path.join("subdir", "test")]))
+
+    def __create_tree(self):
+        dpath = self._get_tempdir()
+        os.mkdir(os.path.join(dpath, "subdir"))
+        util.create_file(os.path.join(dpath, "test0"), "Test0")
+        util.create_file(os.path.join(dpath, "test1"), "Test1")
+        util.create_file(os.path.join(dpath, "subdir", "test"), "Test")
+        return dpath
+
+class IgnoreMatcherTest(TestCase):
+    """ Test IgnoreMatcher. """
+    def test_match(self):
+        matcher = util.IgnoreMatcher([".svn", "*.pyc", "build/", "/setup.py",
+            "doc/*.html"])
+        self.assert_(matcher.match(".svn"))
+        self.assert_(matcher.match(".svn", isdir=True))
+        self.assert_(matcher.match("test.pyc", relpath=os.path.join("a",
+            "test.pyc")))
+        self.assertNot(matcher.match("test.py"))
+        # Directory-only patterns
+        self.assert_(matcher.match("build", isdir=True))
+        self.assertNot(matcher.match("build"))
+        # Anchored patterns
+        self.assert_(matcher.match("setup.py"))
+        self.assertNot(matcher.match("setup.py", relpath=os.path.join("a",
+            "setup.py")))
+        self.assert_(matcher.match("index.html", relpath=os.path.join("doc",
+            "index.html")))
+        self.assertNot(matcher.match("index.html"))
+
+    def test_walkdir(self):
+        """ Test ignoring entries when traversing a directory tree. """
+        dpath = self._get_tempdir()
+        for dname in ("build", os.path.join("src", "build")):
+            os.makedirs(os.path.join(dpath, dname))
+        util.create_file(os.path.join(dpath, "src", "test.pyc"))
+        util.create_file(os.path.join(dpath, "src", "test.py"))
+        util.create_file(os.path.join(dpath, "build.py"))
+        matcher = util.IgnoreMatcher(["/build/", "*.pyc"])
+        walked = [(dpath_[len(dpath):], dnames, fnames) for dpath_, dnames,
+                fnames in util.walkdir(dpath, ignore=matcher, sort=True)]
+        self.assertEqual(walked, [("", ["src"], ["build.py"]),
+            (os.path.sep + "src", ["build"], ["test.py"]),
+            (os.path.join(os.path.sep + "src", "build"), [], [])])
+
+        dstdir = os.path.join(self._get_tempdir(), "copy")
+        util.copy_dir(dpath, dstdir, ignore=matcher)
+        self.assertSortedEqual(os.listdir(dstdir), ["src", "build.py"])
 
 class CommandTest(TestCase):
     """ Test Command class. """
@@ -3,7 +3,6 @@
 @var logger: The srllib L{logger<logging.Logger>}.
 """
 import logging
-import platform
 
 __all__ = ["get_os", "get_os_name", "get_os_version", "Os_Linux",
     "Os_Windows", "logger"]
@@ -33,19 +32,33 @@ Os_Solaris = "sunos"
 OsCollection_Posix = (Os_Linux, Os_Mac, Os_Solaris)
 Os_Posix = OsCollection_Posix   # Backwards-compat
 
+# The platform module, imported on demand
+_platform = None
+# Pair of the platform.uname function used and the result of get_os
+_os_cache = None
+
 def get_os():
     """ Get the current operating system.
 
-    Lower-case strings are used to identify operating systems.
+    Lower-case strings are used to identify operating systems. The result is
+    computed once, unless platform.uname is replaced.
     @return: A pair of OS identifier and OS release (e.g. "xp") strings.
     """
-    name, host, rls, ver, mach, proc = platform.uname()
+    global _platform, _os_cache
+    if _platform is None:
+        import platform as _platform
+    uname = _platform.uname
+    if _os_cache is not None and _os_cache[0] is uname:
+        return _os_cache[1]
+
+    name, host, rls, ver, mach, proc = uname()
     name = name.lower()
     if name == "microsoft":
         # On some Windows versions, it comes out on a different form than usual
         name = rls.lower()
         rls = ver
 
+    _os_cache = uname, (name, rls)
     return name, rls
 
 def get_os_name():
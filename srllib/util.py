@@ -4,15 +4,22 @@
 @var Os_Mac: Identifier for the Mac OS operating system.
 OsCollection_Posix: Collection of identifiers for POSIX OSes.
 """
-import stat, shutil, os.path, imp, fnmatch, sys, errno, \
-        codecs
+from __future__ import absolute_import
+import stat, os.path, sys, errno, re
 try: import hashlib
 except ImportError: import sha
-import functools
+# threading is imported by logging (see srllib._common) anyway
+import functools, collections, threading, binascii, time, struct, io
 
 from srllib.error import *
 from srllib._common import *
 
+try: from os import scandir as _scandir
+except ImportError:
+    # Fall back to the scandir backport, if installed
+    try: from scandir import scandir as _scandir
+    except ImportError: _scandir = None
+
 class PermissionsError(SrlError):
     """ Filesystem permissions error.
     @ivar reason: Original reason for error.
@@ -25,9 +32,314 @@ def no_op(*args, **kwds):
     """ Utility no-op function that accepts any arguments/keywords. """
     pass
 
+class _Task(object):
+    """ A function call queued for execution in a L{_ThreadPool}. """
+    __slots__ = ("func", "args", "notify", "done", "result", "exc_info")
+
+    def __init__(self, func, args, notify=None):
+        self.func, self.args, self.notify = func, args, notify
+        self.done = threading.Event()
+        self.result = self.exc_info = None
+
+    def run(self, canceled):
+        if not canceled:
+            try: self.result = self.func(*self.args)
+            except: self.exc_info = sys.exc_info()
+        self.done.set()
+        if self.notify is not None:
+            self.notify.put(self)
+
+    def get_result(self):
+        """ Wait for the task to finish and return its result.
+
+        An exception raised while executing the task is re-raised here.
+        """
+        self.done.wait()
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_tb = self.exc_info
+            self.exc_info = None
+            raise exc_type, exc_value, exc_tb
+        return self.result
+
+class _ThreadPool(object):
+    """ Pool of daemon worker threads, executing submitted function calls in
+    FIFO order.
+    """
+    def __init__(self, workers):
+        import Queue
+        self.__tasks = Queue.Queue()
+        self.__canceled = threading.Event()
+        self.__threads = []
+        for i in range(workers):
+            thrd = threading.Thread(target=self.__work, name="srllib worker %d"
+                    % (i,))
+            thrd.daemon = True
+            thrd.start()
+            self.__threads.append(thrd)
+
+    def submit(self, func, *args, **kwds):
+        """ Submit a function call for execution.
+        @param notify: Optionally supply a queue to put the task into when
+        done.
+        @return: The L{_Task}.
+        """
+        task = _Task(func, args, kwds.get("notify"))
+        self.__tasks.put(task)
+        return task
+
+    def close(self):
+        """ Skip tasks that haven't been started yet, and join the workers. """
+        self.__canceled.set()
+        for thrd in self.__threads:
+            self.__tasks.put(None)
+        for thrd in self.__threads:
+            thrd.join()
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            task.run(self.__canceled.is_set())
+
+def _parallel_imap(func, iterable, workers, window=None):
+    """ Apply a function to items in a pool of worker threads.
+
+    Results are yielded in the order of the items, while at most C{window}
+    items are processed ahead of the consumer. An exception raised by the
+    function is re-raised when its item is reached. When the generator is
+    closed, items that haven't been started yet are skipped and the workers
+    are joined.
+    @param func: Function to apply to each item.
+    @param iterable: The items, consumed in the calling thread.
+    @param workers: Number of worker threads.
+    @param window: Maximum number of items in flight, by default twice the
+    number of workers.
+    """
+    if window is None:
+        window = workers * 2
+    pool = _ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().get_result()
+        while pending:
+            yield pending.popleft().get_result()
+    finally:
+        pool.close()
+
 Checksum_Hex, Checksum_Binary = 0, 1
 
-def get_checksum(path, format=Checksum_Hex, callback=no_op):
+# Default size of blocks read by I/O loops, in bytes. Block sizes of 1-16 MB
+# work well for large files
+BlockSize_Default = 1024 * 1024
+
+def _check_blocksize(blocksize):
+    if blocksize <= 0:
+        raise ValueError("Invalid block size: %r" % (blocksize,))
+
+def _hash_file(path, hash_obj, callback=no_op, blocksize=BlockSize_Default,
+        mmap_threshold=None):
+    """ Update a hash object with the content of a file.
+
+    The file is read block by block into a single reusable buffer, unless it
+    is at least mmap_threshold bytes large, in which case it is hashed
+    through a memory map.
+    """
+    f = io.open(path, "rb", buffering=0)
+    try:
+        if mmap_threshold is not None:
+            size = os.fstat(f.fileno()).st_size
+            if size and size >= mmap_threshold:
+                import mmap
+                mem = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in xrange(0, size, blocksize):
+                        callback()
+                        hash_obj.update(buffer(mem, offset, blocksize))
+                finally:
+                    mem.close()
+                return
+
+        buf = bytearray(blocksize)
+        view = memoryview(buf)
+        while True:
+            callback()
+            num = f.readinto(buf)
+            hash_obj.update(view[:num])
+            if num < blocksize:
+                break
+    finally:
+        f.close()
+
+# Files modified this recently (in seconds) may still be changing within the
+# timestamp granularity of the filesystem, so their checksums aren't cached
+_RacyInterval = 2
+
+def _stat_key(st):
+    """ Identify a version of a file by device, inode, size and mtime. """
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+def _is_racy(st, now):
+    """ Is the file too recently modified for its stat key to be trusted? """
+    return st.st_mtime >= now - _RacyInterval
+
+class ChecksumCache(object):
+    """ Persistent cache of checksums, keyed by file metadata.
+
+    A file's checksum is stored under its device, inode, size and modification
+    time, so it is only reused for as long as none of these change. The cache
+    holds a bounded number of entries, evicting the least recently used ones
+    first. It is loaded from its file on construction, and written back by
+    L{save}. Pass it to L{get_checksum} or L{compare_dirs} to avoid re-reading
+    unchanged files.
+    """
+    _version = 1
+
+    def __init__(self, path, max_entries=100000):
+        """ @param path: Path to cache file, which needn't exist yet.
+        @param max_entries: Maximum number of cached checksums.
+        """
+        self.__path, self.__max_entries = path, max_entries
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__dirty = False
+
+        try: f = open(path, "rb")
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return
+        import marshal
+        try:
+            # marshal, unlike pickle, can't be tricked into executing code
+            try: version, items = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                logger.debug("Discarding invalid checksum cache '%s'", path)
+                return
+        finally:
+            f.close()
+        if version == self._version:
+            for key, digest in items[-max_entries:]:
+                self.__entries[key] = digest
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def path(self):
+        return self.__path
+
+    def lookup(self, key):
+        """ Look up a binary checksum, marking it as recently used.
+        @return: The checksum, or None if not cached.
+        """
+        self.__lock.acquire()
+        try:
+            digest = self.__entries.pop(key, None)
+            if digest is not None:
+                self.__entries[key] = digest
+            return digest
+        finally:
+            self.__lock.release()
+
+    def store(self, key, digest):
+        """ Store a binary checksum, evicting the least recently used ones if
+        necessary.
+        """
+        self.__lock.acquire()
+        try:
+            self.__entries.pop(key, None)
+            self.__entries[key] = digest
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+            self.__dirty = True
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        """ Remove all entries. """
+        self.__lock.acquire()
+        try:
+            self.__entries.clear()
+            self.__dirty = True
+        finally:
+            self.__lock.release()
+
+    def save(self):
+        """ Write the cache to its file, if modified.
+
+        The file is replaced atomically, so concurrent readers see either the
+        old or the new version.
+        """
+        self.__lock.acquire()
+        try:
+            if not self.__dirty:
+                return
+            items = self.__entries.items()
+            self.__dirty = False
+        finally:
+            self.__lock.release()
+
+        import tempfile, marshal
+        dpath = os.path.dirname(os.path.abspath(self.__path))
+        fd, tmppath = tempfile.mkstemp(prefix=".checksums", dir=dpath)
+        try:
+            f = os.fdopen(fd, "wb")
+            try: marshal.dump((self._version, items), f)
+            finally: f.close()
+            if get_os_name() == Os_Windows and os.path.exists(self.__path):
+                # Can't rename onto an existing file on Windows
+                os.remove(self.__path)
+            os.rename(tmppath, self.__path)
+        except:
+            os.remove(tmppath)
+            raise
+
+def _get_cached_checksum(path, cache, compute, workers=None):
+    """ Get the binary checksum of a file or directory via a L{ChecksumCache}.
+
+    The compute function is called to obtain the checksum if not cached.
+
+    A directory's collective checksum is one stream over all of its files, so
+    it is cached under the metadata of all files, which requires only a
+    traversal (no reading) to look up.
+    """
+    now = time.time()
+    racy = False
+    if os.path.isdir(path):
+        sha_obj = hashlib.sha1()
+        for dpath, dentries, fentries in walkdir(path, sort=True,
+                entries=True, workers=workers):
+            for entry in fentries:
+                st = entry.stat()
+                racy = racy or _is_racy(st, now)
+                sha_obj.update("%s\0%d %d %d %d\n" % ((entry.path[len(path):],)
+                    + _stat_key(st)))
+        key = ("tree", os.path.abspath(path), sha_obj.digest())
+    else:
+        st = os.stat(path)
+        racy = _is_racy(st, now)
+        key = _stat_key(st)
+
+    digest = cache.lookup(key)
+    if digest is None:
+        digest = compute()
+        if not racy:
+            cache.store(key, digest)
+    return digest
+
+# Files up to this size are read ahead in their entirety by get_checksum
+# worker threads, larger files are streamed by the calling thread
+_ReadAheadMax = 1024 * 1024
+
+def get_checksum(path, format=Checksum_Hex, callback=no_op, workers=None,
+        cache=None, blocksize=BlockSize_Default, mmap_threshold=None):
     """ Obtain the sha1 checksum of a file or directory.
 
     If path points to a directory, a collective checksum is calculated
@@ -36,24 +348,43 @@ def get_checksum(path, format=Checksum_Hex, callback=no_op):
     @param format: One of L{Checksum_Hex}, L{Checksum_Binary}.
     @param callback: Optionally supply a callback to be periodically called. Raise
     Canceled from this to cancel the operation.
+    @param workers: Optionally traverse a directory and read its files ahead in
+    pools of this many threads. Since contents are still fed to the checksum
+    in sorted order, the result is the same as without workers.
+    @param cache: Optionally supply a L{ChecksumCache}, for reusing checksums
+    of unmodified files.
+    @param blocksize: Size of blocks to read files in.
+    @param mmap_threshold: Optionally hash files of at least this size through
+    a memory map, instead of reading them.
     @return: If hexadecimal, a 40 byte hexadecimal digest. If binary, a 20byte
     binary digest.
-    @raise ValueError: Invalid format.
+    @raise ValueError: Invalid format or block size.
     @raise Canceled: The callback indicated that the operation should be
     canceled.
     """
     if format not in (Checksum_Hex, Checksum_Binary):
         raise ValueError("Invalid format")
+    _check_blocksize(blocksize)
+
+    if cache is not None:
+        digest = _get_cached_checksum(path, cache, lambda: get_checksum(path,
+            format=Checksum_Binary, callback=callback, workers=workers,
+            blocksize=blocksize, mmap_threshold=mmap_threshold), workers)
+        if format == Checksum_Hex:
+            return binascii.hexlify(digest)
+        return digest
 
     def performSha1(path, shaObj):
+        _hash_file(path, shaObj, callback, blocksize=blocksize,
+                mmap_threshold=mmap_threshold)
+
+    def read_ahead(path):
+        """ Read the content of a small file, or None if it's too large. """
         f = open(path, "rb")
         try:
-            while True:
-                callback()
-                bytes = f.read(8192)
-                shaObj.update(bytes)
-                if len(bytes) < 8192:
-                    break
+            if os.fstat(f.fileno()).st_size > _ReadAheadMax:
+                return path, None
+            return path, f.read()
         finally:
             f.close()
 
@@ -65,14 +396,619 @@ def get_checksum(path, format=Checksum_Hex, callback=no_op):
         shaMthd = shaObj.digest
 
     if os.path.isdir(path):
-        for dpath, dnames, fnames in walkdir(path, sort=True):
-            for fname in fnames:
-                performSha1(os.path.join(dpath, fname), shaObj)
+        fpaths = (os.path.join(dpath, fname) for dpath, dnames, fnames in
+                walkdir(path, sort=True, workers=workers) for fname in fnames)
+        if workers and workers > 1:
+            contents = _parallel_imap(read_ahead, fpaths, workers)
+            try:
+                for fpath, bytes in contents:
+                    if bytes is None:
+                        performSha1(fpath, shaObj)
+                    else:
+                        callback()
+                        shaObj.update(bytes)
+            finally:
+                contents.close()
+        else:
+            for fpath in fpaths:
+                performSha1(fpath, shaObj)
     else:
         performSha1(path, shaObj)
 
     return shaMthd()
 
+class _ChecksumNode(object):
+    """ Node in a L{ChecksumTree}.
+    @ivar kind: "d" for directory, "f" for file and "l" for directory symlink.
+    @ivar digest: Binary checksum.
+    @ivar key: For files, the stat key the checksum is valid for, or None if
+    it can't be trusted.
+    @ivar children: For directories, dictionary of child nodes by name.
+    """
+    __slots__ = ("kind", "digest", "key", "children")
+
+    def __init__(self, kind, digest, key=None, children=None):
+        self.kind, self.digest, self.key, self.children = (kind, digest, key,
+                children)
+
+    def __getstate__(self):
+        return self.kind, self.digest, self.key, self.children
+
+    def __setstate__(self, state):
+        self.kind, self.digest, self.key, self.children = state
+
+class ChecksumTree(object):
+    """ Merkle tree of checksums for a directory tree, as computed by
+    L{get_checksum_tree}.
+
+    Each file's checksum is the SHA-1 of its content, and each directory's
+    checksum is the SHA-1 of its children's names and checksums. Trees can be
+    pickled, for passing to a later L{get_checksum_tree} call.
+    """
+    def __init__(self, root):
+        self.__root = root
+
+    @property
+    def digest(self):
+        """ Binary checksum of the whole tree. """
+        return self.__root.digest
+
+    def hexdigest(self):
+        """ Hexadecimal checksum of the whole tree. """
+        return binascii.hexlify(self.__root.digest)
+
+    def get_digest(self, relpath=""):
+        """ Get the binary checksum of a file or directory in the tree.
+        @param relpath: Path relative to the tree's root.
+        @raise KeyError: No such entry in the tree.
+        """
+        return self._find(relpath).digest
+
+    def iter_dirs(self):
+        """ Iterate over the tree's directories, topdown.
+        @return: Iterator over pairs of relative path and binary checksum.
+        """
+        stack = [("", self.__root)]
+        while stack:
+            relpath, node = stack.pop()
+            yield relpath, node.digest
+            for name in sorted(node.children, reverse=True):
+                child = node.children[name]
+                if child.kind == "d":
+                    stack.append((os.path.join(relpath, name), child))
+
+    def diff(self, other):
+        """ Find the entries that differ from another tree.
+
+        Only subtrees whose checksums differ are visited.
+        @return: Sorted list of relative paths that were added, removed or
+        changed. Added or removed directories are not descended into.
+        """
+        changed = []
+        stack = [("", self.__root, other.__root)]
+        while stack:
+            reldir, node0, node1 = stack.pop()
+            if node0.digest == node1.digest:
+                continue
+            for name in set(node0.children) | set(node1.children):
+                relpath = os.path.join(reldir, name)
+                child0, child1 = (node0.children.get(name),
+                        node1.children.get(name))
+                if child0 is None or child1 is None or child0.kind != \
+                        child1.kind:
+                    changed.append(relpath)
+                elif child0.kind == "d":
+                    stack.append((relpath, child0, child1))
+                elif child0.digest != child1.digest:
+                    changed.append(relpath)
+        return sorted(changed)
+
+    def _find(self, relpath):
+        node = self.__root
+        for name in relpath.split(os.path.sep):
+            if not name:
+                continue
+            if node.children is None:
+                raise KeyError(relpath)
+            node = node.children[name]
+        return node
+
+def get_checksum_tree(path, previous=None, callback=no_op, cache=None):
+    """ Compute a Merkle tree of checksums for a directory tree.
+
+    When given the tree from a previous call, the checksums of files whose
+    metadata (device, inode, size and modification time) are unchanged are
+    reused, as are the checksums of directories with no changes below them.
+    This way only changed files are read, and only directories containing
+    them are re-hashed.
+    @param path: Directory path.
+    @param previous: Optionally, a previously computed L{ChecksumTree} for the
+    same directory.
+    @param callback: Optionally supply a callback to be periodically called.
+    Raise Canceled from this to cancel the operation.
+    @param cache: Optionally supply a L{ChecksumCache} for file checksums.
+    @return: L{ChecksumTree}.
+    @raise Canceled: The callback indicated that the operation should be
+    canceled.
+    """
+    now = time.time()
+    nodes = {}
+    for dpath, dentries, fentries in walkdir(path, topdown=False, sort=True,
+            entries=True):
+        prev = None
+        if previous is not None:
+            try: prev = previous._find(dpath[len(path):])
+            except KeyError: pass
+            else:
+                if prev.kind != "d":
+                    prev = None
+
+        children = {}
+        for entry in dentries:
+            if entry.is_symlink():
+                # Symlinks to directories aren't traversed
+                children[entry.name] = _ChecksumNode("l", hashlib.sha1(
+                    os.readlink(entry.path)).digest())
+            else:
+                children[entry.name] = nodes.pop(entry.path)
+        for entry in fentries:
+            st = entry.stat()
+            key = _stat_key(st)
+            node = None
+            if prev is not None:
+                node = prev.children.get(entry.name)
+            if node is None or node.kind != "f" or node.key != key:
+                if _is_racy(st, now):
+                    key = None
+                node = _ChecksumNode("f", get_checksum(entry.path,
+                    format=Checksum_Binary, callback=callback, cache=cache),
+                    key)
+            children[entry.name] = node
+
+        if prev is not None and len(prev.children) == len(children) and \
+                all(prev.children.get(name) is child for name, child in
+                children.iteritems()):
+            nodes[dpath] = prev
+            continue
+        sha_obj = hashlib.sha1()
+        for name in sorted(children):
+            child = children[name]
+            sha_obj.update("%s%s\0%s" % (child.kind, name, child.digest))
+        nodes[dpath] = _ChecksumNode("d", sha_obj.digest(), children=children)
+
+    return ChecksumTree(nodes[path])
+
+class ManifestEntry(collections.namedtuple("ManifestEntry",
+        "path size mtime digest")):
+    """ Manifest record for a file.
+    @ivar path: Path relative to the manifest's root directory.
+    @ivar size: Size in bytes.
+    @ivar mtime: Modification time, in seconds since the epoch.
+    @ivar digest: Binary digest of the file's content.
+    """
+    __slots__ = ()
+
+def iter_manifest(path, algorithm="sha1", inflight=4, callback=no_op):
+    """ Generate manifest records for the files in a directory tree.
+
+    Records are yielded in sorted traversal order as files are hashed, so a
+    manifest can be consumed (e.g., written with L{write_manifest}) while it
+    is being produced.
+    @param path: Directory path.
+    @param algorithm: Name of L{hashlib} algorithm.
+    @param inflight: Maximum number of files to read concurrently.
+    @param callback: Optionally supply a callback to be called for each
+    record. Raise L{Canceled} from this to cancel the operation.
+    @return: Iterator over L{ManifestEntry} records.
+    @raise ValueError: Unknown hash algorithm.
+    @raise Canceled: The callback requested canceling.
+    """
+    # Validate the algorithm up front, rather than upon iteration
+    hashlib.new(algorithm)
+    if path[-1] != os.path.sep:
+        path += os.path.sep
+    return _iter_manifest(path, algorithm, inflight, callback)
+
+def _iter_manifest(path, algorithm, inflight, callback):
+    def hash_file(relpath):
+        fpath = os.path.join(path, relpath)
+        st = os.stat(fpath)
+        hash_obj = hashlib.new(algorithm)
+        _hash_file(fpath, hash_obj)
+        return ManifestEntry(relpath, st.st_size, st.st_mtime,
+                hash_obj.digest())
+
+    relpaths = (os.path.join(dpath[len(path):], fname) for dpath, dnames,
+            fnames in walkdir(path, sort=True) for fname in fnames)
+    if inflight > 1:
+        entries = _parallel_imap(hash_file, relpaths, inflight, window=inflight)
+    else:
+        entries = (hash_file(relpath) for relpath in relpaths)
+    try:
+        for entry in entries:
+            callback()
+            yield entry
+    finally:
+        entries.close()
+
+_ManifestMagic = "SRLMANIF"
+_ManifestVersion = 1
+_ManifestRecord = struct.Struct("<HQd")
+
+class InvalidManifest(SrlError):
+    pass
+
+def write_manifest(entries, fpath, algorithm="sha1"):
+    """ Write manifest records to a file, in a compact binary format.
+
+    The file consists of a header identifying the hash algorithm, followed by
+    fixed-size record headers (path length, size and modification time), each
+    followed by the path and the binary digest.
+    @param entries: Iterable over L{ManifestEntry} records, e.g. from
+    L{iter_manifest}.
+    @param fpath: Manifest file path.
+    @param algorithm: Hash algorithm the entries were produced with.
+    @return: Number of records written.
+    @raise ValueError: A digest doesn't match the algorithm.
+    """
+    digest_size = hashlib.new(algorithm).digest_size
+    f = open(fpath, "wb")
+    try:
+        f.write(struct.pack("<%dsBB" % (len(_ManifestMagic),), _ManifestMagic,
+            _ManifestVersion, len(algorithm)) + algorithm)
+        num = 0
+        for relpath, size, mtime, digest in entries:
+            if len(digest) != digest_size:
+                raise ValueError("Invalid %s digest for '%s'" % (algorithm,
+                    relpath))
+            if isinstance(relpath, unicode):
+                relpath = relpath.encode("utf-8")
+            relpath = relpath.replace(os.path.sep, "/")
+            f.write(_ManifestRecord.pack(len(relpath), size, mtime) + relpath +
+                    digest)
+            num += 1
+    finally:
+        f.close()
+    return num
+
+def _read_manifest_header(f):
+    hdr_fmt = "<%dsBB" % (len(_ManifestMagic),)
+    hdr = f.read(struct.calcsize(hdr_fmt))
+    try: magic, version, lnth = struct.unpack(hdr_fmt, hdr)
+    except struct.error: raise InvalidManifest(f.name)
+    if magic != _ManifestMagic or version != _ManifestVersion:
+        raise InvalidManifest(f.name)
+    algorithm = f.read(lnth)
+    try: digest_size = hashlib.new(algorithm).digest_size
+    except ValueError: raise InvalidManifest(f.name)
+    return algorithm, digest_size
+
+def get_manifest_algorithm(fpath):
+    """ Get the name of the hash algorithm a manifest file was written with.
+    @raise InvalidManifest: The file isn't a valid manifest.
+    """
+    f = open(fpath, "rb")
+    try: return _read_manifest_header(f)[0]
+    finally: f.close()
+
+def read_manifest(fpath):
+    """ Read records from a manifest file, as written by L{write_manifest}.
+
+    Records are read one at a time, so memory use is independent of the
+    manifest's size.
+    @return: Iterator over L{ManifestEntry} records.
+    @raise InvalidManifest: The file isn't a valid manifest.
+    """
+    f = open(fpath, "rb")
+    try:
+        algorithm, digest_size = _read_manifest_header(f)
+        while True:
+            hdr = f.read(_ManifestRecord.size)
+            if not hdr:
+                break
+            try: lnth, size, mtime = _ManifestRecord.unpack(hdr)
+            except struct.error: raise InvalidManifest(fpath)
+            relpath, digest = f.read(lnth), f.read(digest_size)
+            if len(digest) != digest_size:
+                raise InvalidManifest(fpath)
+            yield ManifestEntry(relpath.replace("/", os.path.sep), size,
+                    mtime, digest)
+    finally:
+        f.close()
+
+def verify_manifest(path, fpath, inflight=4, callback=no_op):
+    """ Verify a directory tree against a manifest file.
+
+    Files are checked for size and content, but not modification time. Files
+    in the directory tree that aren't in the manifest are not considered.
+    @param path: Directory path.
+    @param fpath: Manifest file path.
+    @param inflight: Maximum number of files to read concurrently.
+    @param callback: Optionally supply a callback to be called for each
+    record. Raise L{Canceled} from this to cancel the operation.
+    @return: Pair of mismatched and missing relative paths, respectively.
+    @raise InvalidManifest: The file isn't a valid manifest.
+    @raise Canceled: The callback requested canceling.
+    """
+    algorithm = get_manifest_algorithm(fpath)
+
+    def check(entry):
+        filepath = os.path.join(path, entry.path)
+        try: st = os.stat(filepath)
+        except OSError:
+            return entry.path, None
+        if st.st_size != entry.size:
+            return entry.path, False
+        hash_obj = hashlib.new(algorithm)
+        _hash_file(filepath, hash_obj)
+        return entry.path, hash_obj.digest() == entry.digest
+
+    if inflight > 1:
+        results = _parallel_imap(check, read_manifest(fpath), inflight,
+                window=inflight)
+    else:
+        results = (check(entry) for entry in read_manifest(fpath))
+    mismatch, missing = [], []
+    try:
+        for relpath, ok in results:
+            callback()
+            if ok is None:
+                missing.append(relpath)
+            elif not ok:
+                mismatch.append(relpath)
+    finally:
+        results.close()
+    return mismatch, missing
+
+_SnapshotMagic = "SRLSNAPS"
+_SnapshotVersion = 1
+_SnapshotRecord = struct.Struct("<HIQII")
+_SnapshotFlag_Checksums = 1
+# Size of the sha1 digests stored for files and symlinks
+_SnapshotDigestSize = 20
+
+class InvalidSnapshot(SrlError):
+    pass
+
+def _iter_preorder(path, ignore, unreadable=None):
+    """ Traverse a directory tree in preorder, with the entries of each
+    directory sorted by name.
+
+    This order equals that of the entries' path components. The generator
+    yields pairs of relative path and directory entry. Send it a true value
+    in response to a directory to not descend into it.
+    @param ignore: Predicate for entries to leave out, or None.
+    @param unreadable: Optionally supply a list for relative paths of
+    directories that can't be listed, which are otherwise an error.
+    """
+    def list_dir(dpath, reldir):
+        try: entries = _list_entries(dpath, ignore, False)
+        except EnvironmentError:
+            if unreadable is None:
+                raise
+            unreadable.append(reldir)
+            return iter(())
+        entries = entries[0] + entries[1]
+        entries.sort(key=_get_entry_name)
+        return iter([(os.path.join(reldir, e.name), e) for e in entries])
+
+    stack = [list_dir(path, "")]
+    while stack:
+        for relpath, entry in stack[-1]:
+            prune = yield relpath, entry
+            if prune:
+                # Answer the send call
+                yield None
+            elif entry.is_dir(follow_symlinks=False):
+                stack.append(list_dir(entry.path, relpath))
+                break
+        else:
+            stack.pop()
+
+def _get_snapshot_digest(entry, st, cache):
+    if stat.S_ISLNK(st.st_mode):
+        hash_obj = _new_sha1()
+        hash_obj.update(os.readlink(entry.path))
+        return hash_obj.digest()
+    return get_checksum(entry.path, format=Checksum_Binary, cache=cache)
+
+def snapshot_dir(path, fpath, checksums=False, ignore=None, cache=None,
+        callback=no_op):
+    """ Capture the state of a directory tree in a snapshot file, for later
+    comparison with L{compare_snapshot}.
+
+    For every entry, the snapshot records the relative path and the stat
+    signature compared by L{compare_dirs} (type, size, permissions and
+    ownership), optionally along with a sha1 checksum of each file (or symlink
+    target). Entries are written in a compact binary format as they are
+    traversed, so memory use is independent of the tree's size.
+    @param path: Directory path.
+    @param fpath: Snapshot file path.
+    @param checksums: Record checksums of files?
+    @param ignore: Names of files(/directories) to ignore, or an
+    L{IgnoreMatcher}.
+    @param cache: Optionally supply a L{ChecksumCache} for the checksums.
+    @param callback: Optionally supply a callback to be called for each
+    entry. Raise L{Canceled} from this to cancel the operation.
+    @return: Number of entries recorded.
+    @raise Canceled: The callback requested canceling.
+    """
+    flags = 0
+    if checksums:
+        flags |= _SnapshotFlag_Checksums
+    f = open(fpath, "wb")
+    try:
+        f.write(struct.pack("<%dsBB" % (len(_SnapshotMagic),), _SnapshotMagic,
+            _SnapshotVersion, flags))
+        num = 0
+        for relpath, entry in _iter_preorder(path, _get_ignore_filter(ignore,
+                path)):
+            callback()
+            st = entry.stat(follow_symlinks=False)
+            if isinstance(relpath, unicode):
+                relpath = relpath.encode("utf-8")
+            relpath = relpath.replace(os.path.sep, "/")
+            record = _SnapshotRecord.pack(len(relpath), st.st_mode,
+                    st.st_size, st.st_uid, st.st_gid) + relpath
+            if checksums and not stat.S_ISDIR(st.st_mode):
+                record += _get_snapshot_digest(entry, st, cache)
+            f.write(record)
+            num += 1
+    finally:
+        f.close()
+    return num
+
+def _read_snapshot(fpath, decode=False):
+    """ Read a snapshot file, one record at a time.
+
+    The first item yielded is whether the snapshot has checksums, then
+    records of relative path components, stat signature and digest (or None)
+    follow.
+    @param decode: Decode paths to unicode?
+    """
+    f = open(fpath, "rb")
+    try:
+        hdr_fmt = "<%dsBB" % (len(_SnapshotMagic),)
+        try: magic, version, flags = struct.unpack(hdr_fmt, f.read(
+            struct.calcsize(hdr_fmt)))
+        except struct.error: raise InvalidSnapshot(fpath)
+        if magic != _SnapshotMagic or version != _SnapshotVersion:
+            raise InvalidSnapshot(fpath)
+        has_checksums = bool(flags & _SnapshotFlag_Checksums)
+        yield has_checksums
+
+        while True:
+            hdr = f.read(_SnapshotRecord.size)
+            if not hdr:
+                break
+            try: lnth, mode, size, uid, gid = _SnapshotRecord.unpack(hdr)
+            except struct.error: raise InvalidSnapshot(fpath)
+            relpath = f.read(lnth)
+            if len(relpath) != lnth:
+                raise InvalidSnapshot(fpath)
+            if decode:
+                relpath = relpath.decode("utf-8")
+            digest = None
+            if has_checksums and not stat.S_ISDIR(mode):
+                digest = f.read(_SnapshotDigestSize)
+                if len(digest) != _SnapshotDigestSize:
+                    raise InvalidSnapshot(fpath)
+            yield tuple(relpath.split("/")), (stat.S_IFMT(mode), size,
+                    stat.S_IMODE(mode), uid, gid), digest
+    finally:
+        f.close()
+
+def compare_snapshot(fpath, path, shallow=True, ignore=None, cache=None,
+        callback=no_op):
+    """ Compare a directory tree against a snapshot taken with
+    L{snapshot_dir}.
+
+    The semantics are those of L{diff_dirs}, with the snapshot as the first
+    tree. The snapshot is read as the directory tree is traversed, in the same
+    order, so memory use is independent of the tree's size.
+    @param fpath: Snapshot file path.
+    @param path: Directory path.
+    @param shallow: Don't compare the contents of files? Otherwise, the
+    snapshot must contain checksums.
+    @param ignore: Names of files(/directories) to ignore, or an
+    L{IgnoreMatcher}. This should be the same as when taking the snapshot.
+    @param cache: Optionally supply a L{ChecksumCache} for the checksums.
+    @param callback: Optionally supply a callback to be called for each
+    entry. Raise L{Canceled} from this to cancel the operation.
+    @return: L{DirDiff}.
+    @raise InvalidSnapshot: The file isn't a valid snapshot.
+    @raise ValueError: Contents are to be compared, but the snapshot has no
+    checksums.
+    @raise Canceled: The callback requested canceling.
+    """
+    if not os.path.exists(path):
+        raise ValueError("Directory missing: '%s'" % (path,))
+    records = _read_snapshot(fpath, isinstance(path, unicode))
+    try:
+        if not records.next() and not shallow:
+            raise ValueError("Snapshot has no checksums: '%s'" % (fpath,))
+        diff = DirDiff()
+        unreadable = []
+        live = _iter_preorder(path, _get_ignore_filter(ignore, path),
+                unreadable)
+
+        def next_live():
+            relpath, entry = next(live, (None, None))
+            if relpath is None:
+                return None, None, None
+            return tuple(relpath.split(os.path.sep)), relpath, entry
+
+        def skip_records(key):
+            """ Skip records beneath a path. Return the next record. """
+            lnth = len(key)
+            for record in records:
+                if record[0][:lnth] != key:
+                    return record
+            return None
+
+        def is_unreadable(key):
+            for d in unreadable:
+                d = tuple(d.split(os.path.sep)) if d else ()
+                if key[:len(d)] == d:
+                    return True
+            return False
+
+        record = next(records, None)
+        key, relpath, entry = next_live()
+        while record is not None or key is not None:
+            callback()
+            if record is None or (key is not None and key < record[0]):
+                diff.added.append(relpath)
+                if entry.is_dir(follow_symlinks=False):
+                    live.send(True)
+                key, relpath, entry = next_live()
+                continue
+
+            rec_key, sig0, digest0 = record
+            if key is None or rec_key < key:
+                if unreadable and is_unreadable(rec_key):
+                    # Unknown, since the directory can't be listed
+                    record = next(records, None)
+                    continue
+                diff.removed.append(os.path.sep.join(rec_key))
+                record = skip_records(rec_key) if stat.S_ISDIR(sig0[0]) \
+                        else next(records, None)
+                continue
+
+            # The same path
+            try:
+                st1 = entry.stat(follow_symlinks=False)
+                sig1 = _sig(st1)
+                if sig0[0] != sig1[0]:
+                    diff.type_changed.append(relpath)
+                    if stat.S_ISDIR(sig0[0]):
+                        record = skip_records(rec_key)
+                    else:
+                        record = next(records, None)
+                    if stat.S_ISDIR(sig1[0]):
+                        live.send(True)
+                    key, relpath, entry = next_live()
+                    continue
+
+                if stat.S_ISDIR(sig0[0]):
+                    # Ignore size
+                    if sig0[2:] != sig1[2:]:
+                        diff.metadata_changed.append(relpath)
+                elif sig0 != sig1:
+                    diff.metadata_changed.append(relpath)
+                elif not shallow and _get_snapshot_digest(entry, st1,
+                        cache) != digest0:
+                    diff.content_changed.append(relpath)
+            except EnvironmentError:
+                diff.errors.append(relpath)
+            record = next(records, None)
+            key, relpath, entry = next_live()
+
+        diff.errors.extend([d or os.curdir for d in unreadable])
+    finally:
+        records.close()
+    return diff
+
 def get_module(name, path):
     """ Search for a module along a given path and load it.
     @param name: Module name.
@@ -80,6 +1016,7 @@ def get_module(name, path):
     expressed as a string.
     @raise ValueError: Module not found.
     """
+    import imp
     if isinstance(path, basestring):
         path = [path]
     try:
@@ -131,6 +1068,69 @@ def replace_root(path, new_root, orig_root=None):
     relPath = path[len(orig_root):]
     return os.path.join(new_root, relPath)
 
+class PathRebaser(object):
+    """ Moves paths from one root directory to another, like L{replace_root}
+    with an original root.
+
+    The roots are normalized once up front, so that rebasing a path beneath
+    the original root (as e.g. yielded by L{walkdir}) is only a prefix check
+    and a string concatenation. Other paths are normalized first.
+    """
+    def __init__(self, orig_root, new_root):
+        """
+        @param orig_root: The original root directory.
+        @param new_root: The root directory to move paths to.
+        """
+        # The prefix as joined by walkdir, and the normalized prefix
+        self.__prefix = os.path.join(orig_root, "")
+        self.__norm_root = os.path.normpath(orig_root)
+        self.__norm_prefix = os.path.join(self.__norm_root, "")
+        # If the new root is empty, leave it be
+        if new_root:
+            new_root = os.path.normpath(new_root)
+        self.__new_root = new_root
+        self.__new_prefix = os.path.join(new_root, "")
+
+    @property
+    def orig_root(self):
+        return self.__norm_root
+
+    @property
+    def new_root(self):
+        return self.__new_root
+
+    def rebase(self, path):
+        """ Move a path to the new root.
+        @raise ValueError: The path isn't beneath the original root.
+        """
+        if path.startswith(self.__prefix):
+            return self.__new_prefix + path[len(self.__prefix):]
+        path = os.path.normpath(path)
+        if path.startswith(self.__norm_prefix):
+            return self.__new_prefix + path[len(self.__norm_prefix):]
+        if path == self.__norm_root:
+            return self.__new_root
+        raise ValueError("Path '%s' doesn't start with specified original "
+                "root '%s'" % (path, self.__norm_prefix))
+
+    def rebase_many(self, paths):
+        """ Move several paths to the new root.
+        @return: List of paths.
+        @raise ValueError: A path isn't beneath the original root.
+        """
+        prefix, new_prefix = self.__prefix, self.__new_prefix
+        prefix_len = len(prefix)
+        paths = list(paths)
+        rebased = [new_prefix + p[prefix_len:] for p in paths if
+                p.startswith(prefix)]
+        if len(rebased) != len(paths):
+            rebased = [self.rebase(p) for p in paths]
+        return rebased
+
+    def rebase_relative(self, relpath):
+        """ Join a path relative to the original root with the new root. """
+        return self.__new_prefix + relpath
+
 def _raise_permissions(func):
     """ Decorator for raising PermissionsError upon filesystem access error. """
     @functools.wraps(func)
@@ -149,80 +1149,460 @@ def _raise_permissions(func):
 class DirNotEmpty(SrlError):
     pass
 
+_dir_fd_functions = {}
+
+def _get_dir_fd_function(name):
+    """ Get a function for operating on a file relative to a directory file
+    descriptor, invoked as func(dirfd, name, *args), or None if unsupported.
+
+    Where the os module's function doesn't support dir_fd, the corresponding
+    *at function of the C library is called on Linux.
+    @param name: Name of the os module's function, "unlink" or "chmod".
+    """
+    func = _dir_fd_functions.get(name)
+    if func is not None:
+        return func or None
+
+    func = False
+    os_func = getattr(os, name)
+    if os_func in getattr(os, "supports_dir_fd", ()):
+        def func(dirfd, fname, *args):
+            return os_func(fname, *args, dir_fd=dirfd)
+    elif sys.platform.startswith("linux"):
+        import ctypes
+        try: libc = ctypes.CDLL(None, use_errno=True)
+        except OSError:
+            libc = None
+        libc_func = getattr(libc, {"unlink": "unlinkat", "chmod": "fchmodat"}[
+            name], None)
+        if libc_func is not None:
+            libc_func.restype = ctypes.c_int
+
+            def func(dirfd, fname, *args):
+                if isinstance(fname, unicode):
+                    fname = fname.encode(sys.getfilesystemencoding())
+                # The trailing argument is for flags
+                if libc_func(dirfd, fname, *(args + (0,))) < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err), fname)
+
+    _dir_fd_functions[name] = func
+    return func or None
+
+def _open_dir(path):
+    """ Open a directory file descriptor, or return None on failure. """
+    try: return os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    except EnvironmentError:
+        return None
+
+class _TreeNode(object):
+    """ A directory in a tree being processed by L{_process_tree}. """
+    __slots__ = ("path", "mode", "parent", "pending")
+
+    def __init__(self, path, mode, parent):
+        self.path, self.mode, self.parent, self.pending = path, mode, parent, 0
+
+def _process_tree(root, process, finish, workers=None):
+    """ Process a directory tree depth first, listing each directory once.
+
+    With several workers, independent subtrees are processed concurrently,
+    while the calling thread schedules subdirectories and finishes
+    directories.
+    @param root: L{_TreeNode} of the root directory.
+    @param process: Function that processes a directory's node and returns
+    nodes for its subdirectories.
+    @param finish: Function called in the calling thread with a directory's
+    node, once its subdirectories have been finished.
+    @param workers: Optionally process directories with this many threads.
+    """
+    def finish_up(node):
+        # Finish parent directories as their last subdirectory is finished
+        while node is not None:
+            finish(node)
+            node = node.parent
+            if node is not None:
+                node.pending -= 1
+                if node.pending:
+                    break
+
+    def handle(node, subdirs):
+        node.pending = len(subdirs)
+        if not subdirs:
+            finish_up(node)
+
+    if workers is None or workers <= 1:
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            subdirs = process(node)
+            handle(node, subdirs)
+            stack.extend(subdirs)
+        return
+
+    import Queue
+    pool = _ThreadPool(workers)
+    done = Queue.Queue()
+    try:
+        pool.submit(process, root, notify=done)
+        outstanding = 1
+        while outstanding:
+            task = done.get()
+            outstanding -= 1
+            subdirs = task.get_result()
+            handle(task.args[0], subdirs)
+            for node in subdirs:
+                pool.submit(process, node, notify=done)
+                outstanding += 1
+    finally:
+        pool.close()
+
+class _TreeRemover(object):
+    """ Removes directory trees.
+
+    Each directory is listed once, and its files are unlinked relative to a
+    file descriptor for the directory where supported, which spares the kernel
+    from resolving every file's full path. A directory is removed once its
+    subdirectories are, so with several workers independent subtrees can be
+    cleared concurrently. Permissions of directories are checked as they are
+    listed, while those of files are only fixed (in force mode) if a removal
+    fails.
+    """
+    def __init__(self, ignore_errors, force):
+        self.__ignore_errors, self.__force = ignore_errors, force
+        self.__unlinker = _get_dir_fd_function("unlink")
+
+    def remove(self, path, workers=None):
+        _process_tree(_TreeNode(path, stat.S_IMODE(os.stat(path).st_mode),
+            None), self.__clear_dir, self.__rmdir, workers)
+
+    def __clear_dir(self, dir_):
+        """ Remove the files of a directory.
+        @return: Subdirectories to clear next.
+        """
+        dpath, mode = dir_.path, dir_.mode
+        if not mode & stat.S_IREAD:
+            if not self.__force:
+                raise PermissionsError(dpath)
+            logger.debug("Making directory '%s' traversable by adding exec "
+                    "and read permissions", dpath)
+            mode |= stat.S_IEXEC | stat.S_IREAD
+        if self.__force and not mode & stat.S_IWRITE:
+            # On Unix you can't delete children of read-only directories
+            logger.debug("Making directory '%s' writeable", dpath)
+            mode |= stat.S_IWRITE
+        if mode != dir_.mode:
+            os.chmod(dpath, mode)
+            dir_.mode = mode
+
+        subdirs, fnames = [], []
+        for entry in _scan_dir(dpath):
+            # Symlinks are removed as files, since it doesn't matter if
+            # they're broken
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(_TreeNode(entry.path, stat.S_IMODE(
+                    entry.stat(follow_symlinks=False).st_mode), dir_))
+            else:
+                fnames.append(entry.name)
+        if fnames:
+            self.__remove_files(dpath, fnames)
+        return subdirs
+
+    def __remove_files(self, dpath, fnames):
+        dirfd = None
+        if self.__unlinker is not None:
+            dirfd = _open_dir(dpath)
+        try:
+            for fname in fnames:
+                try: self.__unlink(dirfd, dpath, fname)
+                except EnvironmentError, err:
+                    if not self.__force or err.errno not in (errno.EACCES,
+                            errno.EPERM):
+                        raise
+                    # Windows requires a writeable file
+                    fpath = os.path.join(dpath, fname)
+                    logger.debug("Adding write permission to '%s'", fpath)
+                    os.chmod(fpath, get_file_permissions(fpath) |
+                            stat.S_IWRITE)
+                    self.__unlink(dirfd, dpath, fname)
+        finally:
+            if dirfd is not None:
+                os.close(dirfd)
+
+    def __unlink(self, dirfd, dpath, fname):
+        if dirfd is not None:
+            self.__unlinker(dirfd, fname)
+        else:
+            os.remove(os.path.join(dpath, fname))
+
+    def __rmdir(self, dir_):
+        dpath = dir_.path
+        try: os.rmdir(dpath)
+        except EnvironmentError:
+            logger.debug("Failed to remove directory '%s'", dpath)
+            if not self.__ignore_errors:
+                raise
+
+ReapPriority_Normal, ReapPriority_Low, ReapPriority_Idle = range(3)
+
+# ioprio_set system call numbers, by machine
+_IoprioSetSyscalls = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30,
+        "armv7l": 314, "ppc64": 273, "ppc64le": 273}
+_IoprioClassShift = 13
+_IoprioClass_BestEffort, _IoprioClass_Idle = 2, 3
+
+_io_priority_setter = None
+
+def _set_io_priority(priority):
+    """ Set the I/O priority of the calling thread, where supported (Linux).
+    @param priority: ReapPriority_*.
+    """
+    global _io_priority_setter
+    if priority == ReapPriority_Normal:
+        return
+    if _io_priority_setter is None:
+        import platform
+        _io_priority_setter = False
+        nr = _IoprioSetSyscalls.get(platform.machine())
+        if sys.platform.startswith("linux") and nr is not None:
+            import ctypes
+            try: libc = ctypes.CDLL(None, use_errno=True)
+            except OSError:
+                libc = None
+            if libc is not None:
+                def _io_priority_setter(value):
+                    # Zero denotes the calling thread
+                    return libc.syscall(nr, 1, 0, value) == 0
+    if not _io_priority_setter:
+        return
+
+    if priority == ReapPriority_Idle:
+        value = _IoprioClass_Idle << _IoprioClassShift
+    else:
+        # The lowest best-effort level
+        value = _IoprioClass_BestEffort << _IoprioClassShift | 7
+    if not _io_priority_setter(value):
+        logger.debug("Failed to set I/O priority")
+
+class _Reaper(object):
+    """ Removes trashed files and directories in a pool of threads.
+
+    Targets are moved into a trash directory on the same filesystem, since
+    renaming is atomic and immediate. Trash directories are created under the
+    filesystem's mount point, or the temporary directory, but never in the
+    target's own directory, where they would appear to whoever lists it. A
+    trash directory is shared by the removals on its filesystem, and removed
+    as soon as those are done.
+    """
+    def __init__(self, workers, priority):
+        self.__pool = _ThreadPool(workers)
+        self.__priority = priority
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+        # Trash directories to use, by device, and the number of pending
+        # removals in each
+        self.__trash_dirs = {}
+        self.__trash_pending = {}
+        self.__pending = 0
+        self.__count = 0
+        self.__failed = []
+
+    def trash(self, path, remove):
+        """ Move a file or directory into the trash and schedule its removal.
+        @param remove: Function for removing the trashed path.
+        @return: Was the path moved?
+        """
+        import tempfile
+        path = os.path.abspath(path)
+        dpath = os.path.dirname(path)
+        try:
+            dev = os.lstat(dpath).st_dev
+            real_dpath = os.path.realpath(dpath)
+            locations = [_get_mount_point(dpath), tempfile.gettempdir()]
+        except EnvironmentError:
+            return False
+
+        self.__lock.acquire()
+        try:
+            self.__count += 1
+            name = "%d-%s" % (self.__count, os.path.basename(path))
+            # Pairs of directory and whether to create a trash directory
+            # there
+            candidates = [(l, True) for l in locations]
+            if dev in self.__trash_dirs:
+                candidates.insert(0, (self.__trash_dirs[dev], False))
+            for trash_dir, create in candidates:
+                location = trash_dir if create else os.path.dirname(trash_dir)
+                try:
+                    if os.path.realpath(location) == real_dpath or \
+                            os.lstat(location).st_dev != dev:
+                        continue
+                    if create:
+                        trash_dir = tempfile.mkdtemp(prefix=".srllib-trash-",
+                                dir=location)
+                except EnvironmentError:
+                    continue
+                trashed = os.path.join(trash_dir, name)
+                try: os.rename(path, trashed)
+                except EnvironmentError:
+                    # E.g., a bind mount, or the trash is within the target
+                    if create:
+                        os.rmdir(trash_dir)
+                    continue
+                break
+            else:
+                return False
+
+            self.__trash_dirs[dev] = trash_dir
+            self.__trash_pending[trash_dir] = self.__trash_pending.get(
+                    trash_dir, 0) + 1
+            self.__pending += 1
+        finally:
+            self.__lock.release()
+
+        logger.debug("Moved '%s' to '%s' for removal", path, trashed)
+        self.__pool.submit(self.__reap, path, trashed, remove, dev)
+        return True
+
+    def wait(self):
+        """ Wait for all scheduled removals.
+        @return: Paths that couldn't be removed.
+        """
+        self.__lock.acquire()
+        try:
+            while self.__pending:
+                self.__idle.wait()
+            failed, self.__failed = self.__failed, []
+        finally:
+            self.__lock.release()
+        return failed
+
+    def close(self):
+        failed = self.wait()
+        self.__pool.close()
+        return failed
+
+    def __reap(self, path, trashed, remove, dev):
+        _set_io_priority(self.__priority)
+        try: remove(trashed)
+        except Exception, err:
+            logger.warning("Failed to remove '%s' (moved to '%s'): %s", path,
+                    trashed, err)
+            failed = True
+        else:
+            failed = False
+
+        trash_dir = os.path.dirname(trashed)
+        self.__lock.acquire()
+        try:
+            if failed:
+                self.__failed.append(path)
+            self.__trash_pending[trash_dir] -= 1
+            if not self.__trash_pending[trash_dir]:
+                # Nothing is moved into the trash directory meanwhile, since
+                # we hold the lock
+                del self.__trash_pending[trash_dir]
+                if self.__trash_dirs.get(dev) == trash_dir:
+                    del self.__trash_dirs[dev]
+                try: os.rmdir(trash_dir)
+                except EnvironmentError:
+                    logger.debug("Failed to remove trash directory '%s'",
+                            trash_dir)
+            self.__pending -= 1
+            self.__idle.notify_all()
+        finally:
+            self.__lock.release()
+
+def _get_mount_point(path):
+    """ Get the mount point of the filesystem containing a path. """
+    path = os.path.abspath(path)
+    dev = os.lstat(path).st_dev
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path or os.lstat(parent).st_dev != dev:
+            return path
+        path = parent
+
+_reaper = None
+_reaper_lock = threading.Lock()
+# Whether pending removals are waited for at exit
+_reaper_atexit = False
+
+def _get_reaper():
+    global _reaper
+    _reaper_lock.acquire()
+    try:
+        if _reaper is None:
+            configure_background_removal()
+        return _reaper
+    finally:
+        _reaper_lock.release()
+
+def configure_background_removal(workers=2, priority=ReapPriority_Idle):
+    """ Configure the removal of files and directories in the background (see
+    L{remove_dir}).
+
+    Pending removals are waited for first. Background removals are also
+    waited for when the interpreter exits.
+    @param workers: Number of threads removing files.
+    @param priority: I/O priority of the removing threads, on Linux:
+    ReapPriority_Normal, ReapPriority_Low (the lowest best-effort priority) or
+    ReapPriority_Idle (only when the disk is otherwise idle).
+    @raise ValueError: Invalid number of workers.
+    """
+    global _reaper, _reaper_atexit
+    if workers < 1:
+        raise ValueError("Invalid number of workers: %r" % (workers,))
+    if not _reaper_atexit:
+        import atexit
+        atexit.register(wait_for_removals)
+        _reaper_atexit = True
+    if _reaper is not None:
+        _reaper.close()
+    _reaper = _Reaper(workers, priority)
+
+def wait_for_removals():
+    """ Wait for removals in the background (see L{remove_dir}) to finish.
+    @return: Paths that couldn't be removed since the last call.
+    """
+    if _reaper is None:
+        return []
+    return _reaper.wait()
+
 @_raise_permissions
-def remove_dir(path, ignore_errors=False, force=False, recurse=True):
+def remove_dir(path, ignore_errors=False, force=False, recurse=True,
+        workers=None, background=False):
     """ Remove directory, optionally a whole directory tree (recursively).
 
-    @param ignore_errors: Ignore failed deletions?
-    @param force: On Windows, force deletion of read-only files?
+    @param ignore_errors: Ignore failed deletions of directories?
+    @param force: Force deletion of read-only files and directories, and
+    contents of directories lacking permissions?
     @param recurse: Delete also contents, recursively?
+    @param workers: Optionally remove independent subtrees concurrently, with
+    this many threads.
+    @param background: Move the directory into a trash directory on the same
+    filesystem (under its mount point or the temporary directory, never
+    beside the directory), and remove it from there in the background? If
+    the directory can't be moved, it is removed immediately. Use L{wait_for_removals} to
+    wait for removals to finish, and L{configure_background_removal} to
+    configure them.
     @raise ValueError: The directory doesn't exist.
     @raise PermissionsError: Missing file-permissions.
     @raise DirNotEmpty: Directory was not empty, and recurse was not specified.
     """
     logger.debug("Removing directory '%s' (ignore_errors: %s, force: %s, "
-        "recurse: %s)" % (path, ignore_errors, force, recurse))
-
-    def rmdir(path):
-        if force:
-            # When in force mode, make the directory writeable if necessary
-            mode = get_file_permissions(path)
-            if not mode & stat.S_IWRITE:
-                logger.debug("Adding write permission to directory '%s'" %
-                        (path,))
-                mode |= stat.S_IWRITE
-                chmod(path, mode)
-
-        assert not os.listdir(path), "Directory not empty: '%s'" % (path,)
-        logger.debug("Removing directory '%s' itself" % (path,))
-        try: os.rmdir(path)
-        except OSError:
-            logger.debug("Failed to remove directory '%s'" % (path,))
-            if not ignore_errors:
-                raise
-
-    def handle_err(dpath):
-        """Hook for handling errors in walkdir."""
-        if not force:
-            raise PermissionsError(dpath)
-        logger.debug("Making directory '%s' traversable by adding exec and read permissions" %
-                (dpath,))
-        os.chmod(dpath, stat.S_IEXEC | stat.S_IREAD)
-        return True
-
+        "recurse: %s, background: %s)", path, ignore_errors, force, recurse,
+        background)
     if not os.path.exists(path):
         raise ValueError("Directory doesn't exist: %s" % path)
 
-    if recurse:
-        for dpath, dnames, fnames in walkdir(path, topdown=False, errorfunc=
-                handle_err):
-            logger.debug("In directory '%s', subdirectories: %r, child files: %r" %
-                    (dpath, dnames, fnames))
-
-            if force:
-                # Make the directory writeable if necessary -- on Unix you
-                # can't delete children of read-only directories
-                mode = get_file_permissions(dpath)
-                if not mode & stat.S_IWRITE:
-                    logger.debug("Making directory '%s' writeable" % (dpath,))
-                    mode |= stat.S_IWRITE
-                    chmod(dpath, mode)
-            
-            for d in dnames:
-                abspath = os.path.join(dpath, d)
-                if not os.path.islink(abspath):
-                    rmdir(abspath)
-                else:
-                    # Better to remove symlinks as files, since it doesn't
-                    # matter if they're broken
-                    logger.debug("'%s' is a link" % (d,))
-                    remove_file(abspath, force=force)
-            for f in fnames:
-                remove_file(os.path.join(dpath, f), force=force)
-    else:
-        if os.listdir(path):
-            raise DirNotEmpty
-    rmdir(path)
+    remover = _TreeRemover(ignore_errors, force)
+    if not recurse and os.listdir(path):
+        raise DirNotEmpty
+    if background and recurse and _get_reaper().trash(path, functools.partial(
+            remover.remove, workers=workers)):
+        return
+    # Without recursion, the directory is empty
+    remover.remove(path, workers=workers)
 
 @_raise_permissions
 def get_file_permissions(path):
@@ -240,6 +1620,7 @@ def move_file(src, dest, force=False):
     different platforms.
     @param force: On Windows, overwrite write-protected destination?
     """
+    import shutil
     if get_os_name() == Os_Windows and os.path.isfile(dest):    #pragma: optional
         # Necessary on Windows
         if force:
@@ -256,100 +1637,815 @@ def clean_path(path):
 def _walkdir_handle_err(path):
     raise PermissionsError(path)
 
+class _DirEntry(object):
+    """ Directory entry, for when scandir isn't available.
+
+    This mimics os.DirEntry. The entry is lstat'ed once, when first
+    examined, and the result is cached. Only symlinks need an additional stat
+    call, if their targets are examined.
+    """
+    __slots__ = ("name", "path", "__lstat", "__stat")
+
+    def __init__(self, dpath, name):
+        self.name, self.path = name, os.path.join(dpath, name)
+        self.__lstat = self.__stat = None
+
+    def __repr__(self):
+        return "<DirEntry %r>" % (self.name,)
+
+    def inode(self):
+        return self.stat(follow_symlinks=False).st_ino
+
+    def is_dir(self, follow_symlinks=True):
+        try: st = self.stat(follow_symlinks=follow_symlinks)
+        except OSError: return False
+        return stat.S_ISDIR(st.st_mode)
+
+    def is_file(self, follow_symlinks=True):
+        try: st = self.stat(follow_symlinks=follow_symlinks)
+        except OSError: return False
+        return stat.S_ISREG(st.st_mode)
+
+    def is_symlink(self):
+        try: st = self.stat(follow_symlinks=False)
+        except OSError: return False
+        return stat.S_ISLNK(st.st_mode)
+
+    def stat(self, follow_symlinks=True):
+        if self.__lstat is None:
+            self.__lstat = os.lstat(self.path)
+        if not follow_symlinks or not stat.S_ISLNK(self.__lstat.st_mode):
+            return self.__lstat
+        if self.__stat is None:
+            self.__stat = os.stat(self.path)
+        return self.__stat
+
+def _scan_dir(path):
+    """ List a directory as directory entries. """
+    if _scandir is not None:
+        return list(_scandir(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+def _get_entry_name(entry):
+    return entry.name
+
+def _compile_globs(patterns):
+    """ Compile glob patterns into a set of literal strings and a combined
+    regular expression for the rest (None if there are none).
+    """
+    import fnmatch
+    literals, exprs = set(), []
+    for ptrn in patterns:
+        if "*" in ptrn or "?" in ptrn or "[" in ptrn:
+            expr = fnmatch.translate(ptrn)
+            # Older Python versions append the flags, which may only be given
+            # once
+            if expr.endswith("(?ms)"):
+                expr = expr[:-5]
+            exprs.append(expr)
+        else:
+            literals.add(ptrn)
+    if not exprs:
+        return literals, None
+    return literals, re.compile("|".join(["(?:%s)" % (e,) for e in exprs]),
+            re.S)
+
+class IgnoreMatcher(object):
+    """ Compiled set of glob patterns, for ignoring filesystem entries.
+
+    Patterns are matched like with fnmatch, against entry names. Patterns
+    without wildcards are looked up in a set, the rest are combined into one
+    regular expression. A pattern ending with "/" only matches directories.
+    A pattern containing "/" otherwise is anchored, i.e. matched against the
+    path relative to the root directory (with "/" separators), e.g. "build/*.o"
+    or "/setup.py".
+    """
+    def __init__(self, patterns):
+        """
+        @param patterns: Sequence of glob patterns.
+        """
+        # Follow the case sensitivity of fnmatch
+        self.__fold = os.path.normcase("A") == "a"
+        groups = {}
+        for ptrn in patterns:
+            if self.__fold:
+                ptrn = ptrn.lower()
+            ptrn = ptrn.replace(os.path.sep, "/")
+            dir_only = ptrn.endswith("/")
+            if dir_only:
+                ptrn = ptrn.rstrip("/")
+            anchored = "/" in ptrn
+            if anchored:
+                ptrn = ptrn.lstrip("/")
+            groups.setdefault((anchored, dir_only), []).append(ptrn)
+
+        self.__patterns = tuple(patterns)
+        self.__names, self.__dir_names, self.__paths, self.__dir_paths = [
+                _compile_globs(groups.get(key, ())) for key in ((False, False),
+                    (False, True), (True, False), (True, True))]
+        self.__has_dir_only = (False, True) in groups or (True, True) in groups
+        self.__has_anchored = (True, False) in groups or (True, True) in groups
+
+    def __repr__(self):
+        return "IgnoreMatcher(%r)" % (list(self.__patterns),)
+
+    @property
+    def patterns(self):
+        return self.__patterns
+
+    def match(self, name, isdir=False, relpath=None):
+        """ Should a filesystem entry be ignored?
+        @param name: Entry name.
+        @param isdir: Is the entry a directory?
+        @param relpath: Path of the entry relative to the root directory, for
+        anchored patterns. If None, the entry is taken to be in the root.
+        """
+        if self.__fold:
+            name = name.lower()
+        if self.__match(self.__names, name) or (isdir and self.__match(
+                self.__dir_names, name)):
+            return True
+        if not self.__has_anchored:
+            return False
+
+        if relpath is None:
+            relpath = name
+        else:
+            if self.__fold:
+                relpath = relpath.lower()
+            relpath = relpath.replace(os.path.sep, "/")
+        return self.__match(self.__paths, relpath) or (isdir and self.__match(
+            self.__dir_paths, relpath))
+
+    def _get_entry_filter(self, root):
+        """ Get a predicate for entries to ignore when traversing a directory
+        tree.
+        """
+        prefix_len = len(os.path.join(root, ""))
+        has_dir_only, has_anchored = self.__has_dir_only, self.__has_anchored
+        match = self.match
+
+        def is_ignored(entry):
+            relpath = None
+            if has_anchored:
+                relpath = entry.path[prefix_len:]
+            return match(entry.name, has_dir_only and entry.is_dir(), relpath)
+
+        return is_ignored
+
+    def __match(self, group, s):
+        literals, expr = group
+        return s in literals or (expr is not None and expr.match(s) is not
+                None)
+
+def _get_ignore_filter(ignore, root):
+    """ Get a predicate for entries to ignore, or None.
+    @param ignore: An L{IgnoreMatcher}, or a collection of names.
+    """
+    if isinstance(ignore, IgnoreMatcher):
+        return ignore._get_entry_filter(root)
+    if not ignore:
+        return None
+    names = frozenset(ignore)
+    def is_ignored(entry):
+        return entry.name in names
+    return is_ignored
+
+def _list_walkdir(path, mode, errorfunc, ignore, sort):
+    """ List a directory for walkdir.
+    @return: Pair of directory and file entry lists, or None if the directory
+    should be ignored.
+    """
+    if not mode & stat.S_IREAD:
+        if not errorfunc(path):
+            # Ignore directory
+            return None
+    return _list_entries(path, ignore, sort)
+
+def _list_entries(path, ignore, sort):
+    """ List a directory as a pair of directory and file entry lists.
+    @param ignore: Predicate for entries to leave out, or None.
+    """
+    dentries, fentries = [], []
+    for entry in _scan_dir(path):
+        if ignore is not None and ignore(entry):
+            continue
+
+        if entry.is_dir():
+            dentries.append(entry)
+        else:
+            fentries.append(entry)
+
+    if sort:
+        dentries.sort(key=_get_entry_name)
+        fentries.sort(key=_get_entry_name)
+    return dentries, fentries
+
+class _WalkdirPrefetcher(object):
+    """ Lists directories ahead of an ordered walkdir traversal, in a thread
+    pool.
+
+    Only directories that are readable according to their permissions are
+    listed ahead, since errorfunc must be invoked in the traversing thread.
+    """
+    def __init__(self, pool, ignore, sort, window):
+        self.__pool, self.__ignore, self.__sort, self.__window = (pool, ignore,
+                sort, window)
+        self.__tasks = {}
+
+    def prefetch(self, pending):
+        """ Make sure the next directories to be visited are being listed.
+        @param pending: Directory entries to be visited, in reverse order.
+        """
+        for entry in pending[-self.__window:]:
+            if entry.path in self.__tasks or entry.is_symlink():
+                continue
+            if entry.stat(follow_symlinks=False).st_mode & stat.S_IREAD:
+                self.__tasks[entry.path] = self.__pool.submit(_list_entries,
+                        entry.path, self.__ignore, self.__sort)
+
+    def list(self, path, mode, errorfunc):
+        """ Get the listing of a directory, as from L{_list_walkdir}. """
+        task = self.__tasks.pop(path, None)
+        if task is None:
+            return _list_walkdir(path, mode, errorfunc, self.__ignore,
+                    self.__sort)
+        return task.get_result()
+
+def _walkdir(path, mode, errorfunc, topdown, ignore, sort, prefetcher=None):
+    """ Traverse a directory tree, using an explicit stack.
+
+    Each stack frame holds a directory's subdirectories that remain to be
+    visited, in reverse order so they can be popped off as they are visited.
+    In topdown mode, that is all that's kept of a directory once it has been
+    yielded, while in bottom-up mode its entry lists are also kept until it
+    is yielded after its subdirectories.
+    @param prefetcher: Optionally, L{_WalkdirPrefetcher} for listing
+    directories ahead.
+    """
+    listing = _list_walkdir(path, mode, errorfunc, ignore, sort)
+    if listing is None:
+        return
+
+    stack = []
+    while True:
+        dentries, fentries = listing
+        if topdown:
+            yield path, dentries, fentries
+            # The caller may have excluded subdirectories
+            stack.append((path, dentries[::-1], None, None))
+        else:
+            stack.append((path, dentries[::-1], dentries, fentries))
+        del dentries, fentries
+
+        listing = None
+        while stack:
+            path, pending, dentries, fentries = stack[-1]
+            while pending:
+                if prefetcher is not None:
+                    prefetcher.prefetch(pending)
+                entry = pending.pop()
+                if entry.is_symlink():
+                    continue
+                # Permissions come from the entry's cached stat
+                mode = stat.S_IMODE(entry.stat(follow_symlinks=False).st_mode)
+                if prefetcher is not None:
+                    listing = prefetcher.list(entry.path, mode, errorfunc)
+                else:
+                    listing = _list_walkdir(entry.path, mode, errorfunc,
+                            ignore, sort)
+                if listing is not None:
+                    path = entry.path
+                    break
+            if listing is not None:
+                break
+
+            stack.pop()
+            if not topdown:
+                yield path, dentries, fentries
+        else:
+            return
+
+class _WalkdirNode(object):
+    """ Directory awaiting its subdirectories in a bottom-up, unordered
+    parallel walkdir traversal.
+    """
+    __slots__ = ("path", "parent", "dentries", "fentries", "remaining")
+
+    def __init__(self, path, parent):
+        self.path, self.parent = path, parent
+        self.dentries = self.fentries = None
+        self.remaining = 0
+
+def _walkdir_unordered(path, mode, errorfunc, topdown, ignore, pool):
+    """ Traverse a directory tree, listing directories concurrently in a
+    thread pool.
+
+    Directories are yielded as their listings complete. In topdown mode, a
+    directory's subdirectories are submitted for listing once it has been
+    yielded. In bottom-up mode, a directory is yielded once all of its
+    subdirectories have been yielded.
+    """
+    import Queue
+    done = Queue.Queue()
+    outstanding = [0]
+
+    def list_node(node):
+        return node, _list_entries(node.path, ignore, False)
+
+    def submit(node, mode):
+        if not mode & stat.S_IREAD:
+            # errorfunc must be called from the traversing thread
+            if not errorfunc(node.path):
+                return False
+        outstanding[0] += 1
+        pool.submit(list_node, node, notify=done)
+        return True
+
+    def submit_children(node):
+        for entry in node.dentries:
+            if entry.is_symlink():
+                continue
+            if submit(_WalkdirNode(entry.path, node), stat.S_IMODE(entry.stat(
+                    follow_symlinks=False).st_mode)):
+                node.remaining += 1
+
+    if not submit(_WalkdirNode(path, None), mode):
+        return
+    while outstanding[0]:
+        task = done.get()
+        outstanding[0] -= 1
+        node, (node.dentries, node.fentries) = task.get_result()
+        if topdown:
+            yield node.path, node.dentries, node.fentries
+            submit_children(node)
+            node.dentries = node.fentries = None
+            continue
+
+        submit_children(node)
+        # Yield the directory if it has no subdirectories to wait for, and in
+        # turn any ancestors that were only waiting for it
+        while node is not None and not node.remaining:
+            yield node.path, node.dentries, node.fentries
+            node.dentries = node.fentries = None
+            node = node.parent
+            if node is not None:
+                node.remaining -= 1
+
 @_raise_permissions
 def walkdir(path, errorfunc=None, topdown=True, ignore=None,
-        sort=False):
+        sort=False, entries=False, workers=None):
     """ Directory tree generator.
 
     This function works in much the same way as os.walk, but expands somewhat
-    on that.
+    on that. Directories are listed with scandir where available (Python 3.5
+    or the scandir package), so that file types needn't be determined by
+    separate system calls.
+
+    When traversing topdown, subdirectories removed from the yielded
+    directory list aren't traversed.
     @param path: Directory to traverse.
     @param errorfunc: Function to handle error when a directory can't be
     traversed. Return False from this to ignore directory.
     @param topdown: Traverse in topdown fashion?
-    @param ignore: Optionally provide a set of filenames to ignore.
+    @param ignore: Optionally provide a set of filenames to ignore, or an
+    L{IgnoreMatcher}.
     @param sort: Traverse entries in sorted fashion?
+    @param entries: Yield directory entries (like those of os.scandir, with
+    cached stat results) instead of names?
+    @param workers: Optionally list directories concurrently in a pool of
+    this many threads, which pays off on high-latency filesystems such as NFS.
+    If sort is true, sibling directories are listed ahead and the output is
+    the same as without workers. Otherwise, directories are yielded in the
+    order their listings complete (parents are still yielded before their
+    subdirectories when traversing topdown, and vice versa).
     @raise PermissionsError: Missing permission to traverse directory.
     """
     if errorfunc is None:
         errorfunc = _walkdir_handle_err
+    ignore = _get_ignore_filter(ignore, path)
 
     mode = get_file_permissions(path)
-    if not mode & stat.S_IREAD:
-        if not errorfunc(path):
-            # Ignore directory
-            return
-
-    if ignore is None:
-        ignore = []
+    pool = None
+    if workers and workers > 1:
+        pool = _ThreadPool(workers)
+        if sort:
+            walker = _walkdir(path, mode, errorfunc, topdown, ignore, sort,
+                    _WalkdirPrefetcher(pool, ignore, sort, workers * 2))
+        else:
+            walker = _walkdir_unordered(path, mode, errorfunc, topdown, ignore,
+                    pool)
+    else:
+        walker = _walkdir(path, mode, errorfunc, topdown, ignore, sort)
 
-    dnames, fnames = [], []
-    for e in os.listdir(path):
-        if e in ignore:
-            continue
+    try:
+        if entries:
+            for x in walker:
+                yield x
+            return
 
-        if os.path.isdir(os.path.join(path, e)):
-            dnames.append(e)
-        else:
-            fnames.append(e)
+        for dpath, dentries, fentries in walker:
+            dnames = [e.name for e in dentries]
+            yield dpath, dnames, [e.name for e in fentries]
+            if topdown:
+                # Traverse the subdirectories as left in the list by the caller
+                by_name = dict((e.name, e) for e in dentries)
+                dentries[:] = [by_name.get(name) or _DirEntry(dpath, name) for
+                        name in dnames]
+    finally:
+        if pool is not None:
+            walker.close()
+            pool.close()
+
+# errno values from in-kernel copying that mean the method doesn't apply to
+# the files at hand, so the next one should be tried
+_KernelCopyFallback = frozenset([errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+    errno.EBADF, errno.EPERM, errno.EOPNOTSUPP, getattr(errno, "ENOTSUP",
+    errno.EOPNOTSUPP)])
+
+_kernel_copiers = None
+
+def _get_libc_copiers():
+    """ Wrap copy_file_range and sendfile from the C library, for Python
+    versions that lack them in the os module.
+    """
+    import ctypes
+    try: libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None, None
+
+    def check(result):
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+
+    copy_file_range = sendfile = None
+    c_off_p = ctypes.POINTER(ctypes.c_int64)
+    if hasattr(libc, "copy_file_range"):
+        libc_copy_file_range = libc.copy_file_range
+        libc_copy_file_range.argtypes = [ctypes.c_int, c_off_p, ctypes.c_int,
+                c_off_p, ctypes.c_size_t, ctypes.c_uint]
+        libc_copy_file_range.restype = ctypes.c_ssize_t
+
+        def copy_file_range(srcfd, dstfd, count, srcoff, dstoff):
+            srcoff, dstoff = ctypes.c_int64(srcoff), ctypes.c_int64(dstoff)
+            while True:
+                try:
+                    return check(libc_copy_file_range(srcfd, ctypes.byref(
+                        srcoff), dstfd, ctypes.byref(dstoff), count, 0))
+                except OSError, err:
+                    if err.errno != errno.EINTR:
+                        raise
+    if hasattr(libc, "sendfile64"):
+        libc_sendfile = libc.sendfile64
+        libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, c_off_p,
+                ctypes.c_size_t]
+        libc_sendfile.restype = ctypes.c_ssize_t
+
+        def sendfile(dstfd, srcfd, srcoff, count):
+            srcoff = ctypes.c_int64(srcoff)
+            while True:
+                try:
+                    return check(libc_sendfile(dstfd, srcfd, ctypes.byref(
+                        srcoff), count))
+                except OSError, err:
+                    if err.errno != errno.EINTR:
+                        raise
+
+    return copy_file_range, sendfile
+
+def _get_kernel_copiers():
+    """ Get the available methods of copying file data in the kernel, in order
+    of preference.
+
+    Each method is a function invoked as func(srcfd, dstfd, offset, count),
+    which copies up to count bytes from offset in the source file to the same
+    offset in the destination file and returns the number of bytes copied.
+    """
+    global _kernel_copiers
+    if _kernel_copiers is not None:
+        return _kernel_copiers
+
+    copiers = []
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    if sys.platform.startswith("linux"):
+        if copy_file_range is None or sendfile is None:
+            libc_copiers = _get_libc_copiers()
+            copy_file_range = copy_file_range or libc_copiers[0]
+            sendfile = sendfile or libc_copiers[1]
+
+        if copy_file_range is not None:
+            def copy_range(srcfd, dstfd, offset, count):
+                return copy_file_range(srcfd, dstfd, count, offset, offset)
+            copiers.append(copy_range)
+        # On other systems, sendfile only supports sockets as destination
+        if sendfile is not None:
+            def send_range(srcfd, dstfd, offset, count):
+                os.lseek(dstfd, offset, os.SEEK_SET)
+                return sendfile(dstfd, srcfd, offset, count)
+            copiers.append(send_range)
+
+    _kernel_copiers = copiers
+    return copiers
+
+def _copy_data(src, dst, offset, end, buf, progress, hash_obj=None):
+    """ Copy the data of a file, from an offset up to the same offset in the
+    destination file.
+
+    The data is copied in the kernel if possible, otherwise it is read into
+    and written from buf. Chunks are as large as buf.
+    @param src: Source file object.
+    @param dst: Destination file object.
+    @param end: Offset to stop at, None to copy to the end of the file.
+    @param progress: Invoked with the offset reached after each chunk.
+    @param hash_obj: Optionally update this hash object with the data, which
+    is then always read into buf.
+    @return: The offset copied up to.
+    """
+    blocksize = len(buf)
+    srcfd, dstfd = src.fileno(), dst.fileno()
+    if hash_obj is None:
+        copiers = _get_kernel_copiers()
+    else:
+        copiers = ()
+    for copier in copiers:
+        try:
+            while end is None or offset < end:
+                count = blocksize
+                if end is not None:
+                    count = min(count, end - offset)
+                copied = copier(srcfd, dstfd, offset, count)
+                if copied == 0:
+                    # Either end of file was reached, or the file doesn't
+                    # support the method (e.g., in /proc); in both cases the
+                    # regular loop determines the outcome
+                    break
+                offset += copied
+                progress(offset)
+            else:
+                return offset
+            break
+        except OSError, err:
+            if err.errno not in _KernelCopyFallback:
+                raise
 
-    if sort:
-        dnames = sorted(dnames)
-        fnames = sorted(fnames)
+    # Read into the same buffer over and over, and write directly from it
+    src.seek(offset)
+    dst.seek(offset)
+    view = memoryview(buf)
+    while end is None or offset < end:
+        count = blocksize
+        if end is not None:
+            count = min(count, end - offset)
+        bytesRead = src.readinto(view[:count])
+        if hash_obj is not None:
+            hash_obj.update(view[:bytesRead])
+        written = 0
+        while written < bytesRead:
+            written += dst.write(view[written:bytesRead])
+        if bytesRead:
+            offset += bytesRead
+            progress(offset)
+        if bytesRead < count:
+            break
+    return offset
+
+CopyMethod_Copy, CopyMethod_Reflink, CopyMethod_Hardlink = range(3)
+
+# The FICLONE ioctl request, for sharing the extents of one file with another
+# on Linux filesystems such as btrfs and XFS
+_FICLONE = 0x40049409
+
+# errno values from cloning or linking that mean it's not possible for the
+# files at hand, so they should be copied instead
+_CloneFallback = frozenset([errno.EXDEV, errno.EINVAL, errno.EPERM,
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EMLINK, errno.ENOSYS, getattr(errno,
+    "ENOTSUP", errno.EOPNOTSUPP)])
+
+def _clone_file(src, dst):
+    """ Make a file share the extents of another file.
+    @param src: Source file object.
+    @param dst: Destination file object.
+    @return: Was the file cloned?
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    try: fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except EnvironmentError, err:
+        if err.errno not in _CloneFallback:
+            raise
+        return False
+    return True
 
-    if topdown:
-        yield path, dnames, fnames
-    for d in dnames:
-        if os.path.islink(os.path.join(path, d)):
-            continue
-        for x in walkdir(os.path.join(path, d), errorfunc=errorfunc,
-                topdown=topdown, ignore=ignore, sort=sort):
-            yield x
-    if not topdown:
-        yield path, dnames, fnames
+def _link_file(srcpath, dstpath):
+    """ Replace a file with a hard link to another file.
+    @return: Was the link created?
+    """
+    if not hasattr(os, "link"):
+        return False
+    if os.path.lexists(dstpath):
+        os.remove(dstpath)
+    try: os.link(srcpath, dstpath)
+    except OSError, err:
+        if err.errno not in _CloneFallback:
+            raise
+        return False
+    return True
+
+# lseek whence values for finding data and holes in sparse files, which are
+# missing from the os module in older Python versions
+_SEEK_DATA, _SEEK_HOLE = (getattr(os, "SEEK_DATA", None), getattr(os,
+    "SEEK_HOLE", None))
+if _SEEK_DATA is None and sys.platform.startswith("linux"):
+    _SEEK_DATA, _SEEK_HOLE = 3, 4
+
+def _is_sparse(st):
+    """ Does a file (probably) have holes? """
+    blocks = getattr(st, "st_blocks", None)
+    return _SEEK_DATA is not None and blocks is not None and blocks * 512 < \
+            st.st_size
+
+def _copy_sparse(src, dst, size, buf, progress, hash_obj=None):
+    """ Copy the data extents of a sparse file, reproducing its holes.
+
+    Holes are found with lseek. Data beyond the given size is not copied.
+    @param size: Size of the source file.
+    @param progress: Invoked with the offset reached after each chunk (see
+    L{_copy_data}).
+    @param hash_obj: Optionally update this hash object with the file content,
+    including the zeros of the holes.
+    @return: Was the file copied? If holes can't be found in the file,
+    nothing is copied.
+    """
+    def hash_zeros(count):
+        zeros = memoryview(bytearray(min(count, len(buf))))
+        while count > 0:
+            hash_obj.update(zeros[:count])
+            count -= len(zeros)
+
+    srcfd = src.fileno()
+    offset = 0
+    while offset < size:
+        try: data = os.lseek(srcfd, offset, _SEEK_DATA)
+        except OSError, err:
+            if err.errno == errno.ENXIO:
+                # No more data
+                break
+            if offset == 0 and err.errno == errno.EINVAL:
+                # Not supported
+                return False
+            raise
+        if data >= size:
+            break
+        hole = min(os.lseek(srcfd, data, _SEEK_HOLE), size)
+        if hash_obj is not None and data > offset:
+            hash_zeros(data - offset)
+        offset = _copy_data(src, dst, data, hole, buf, progress, hash_obj)
+        if offset < hole:
+            # The file shrank
+            break
+
+    if offset < size:
+        if hash_obj is not None:
+            hash_zeros(size - offset)
+        progress(size)
+    # Extend the file with a trailing hole, if any
+    dst.truncate(size)
+    return True
+
+def _new_sha1():
+    try: return hashlib.sha1()
+    except NameError: return sha.new()
+
+def _get_digest(hash_obj, format):
+    if format == Checksum_Hex:
+        return hash_obj.hexdigest()
+    return hash_obj.digest()
 
 @_raise_permissions
-def _copy_file(srcpath, dstpath, callback, fs_mode=None):
+def _copy_file(srcpath, dstpath, callback, fs_mode=None,
+        blocksize=BlockSize_Default, method=CopyMethod_Copy, checksum=None,
+        verify=False):
     if not os.path.exists(srcpath):
         raise MissingSource(srcpath)
+    _check_blocksize(blocksize)
+    if checksum not in (None, Checksum_Hex, Checksum_Binary):
+        raise ValueError("Invalid checksum format")
+    if method == CopyMethod_Hardlink and fs_mode is not None:
+        raise ValueError("A mode can't be specified for hard links")
+    hash_obj = None
+    if checksum is not None:
+        hash_obj = _new_sha1()
+
+    if method == CopyMethod_Hardlink and _link_file(srcpath, dstpath):
+        # The link shares its mode (and content) with the source
+        callback(100)
+        if hash_obj is not None:
+            _hash_file(srcpath, hash_obj, blocksize=blocksize)
+            return _get_digest(hash_obj, checksum)
+        return
 
     st = os.stat(srcpath)
+    try: dst_st = os.stat(dstpath)
+    except OSError:
+        dst_st = None
+    if dst_st is not None and st.st_ino and (dst_st.st_dev, dst_st.st_ino) == \
+            (st.st_dev, st.st_ino):
+        if os.path.realpath(srcpath) == os.path.realpath(dstpath):
+            raise ValueError("Source and destination are the same file: '%s'"
+                    % (srcpath,))
+        # The destination is e.g. a hard link to the source, which would be
+        # truncated when opened for writing
+        os.remove(dstpath)
+
     sz = float(st.st_size)
     if sz == 0:
         # Just create the destination file
         file(dstpath, "wb").close()
         callback(100)
     else:
-        src = file(srcpath, "rb")
-        dst = file(dstpath, "wb")
+        src = io.open(srcpath, "rb", buffering=0)
         try:
-            while True:
-                bytes = src.read(8192)
-                dst.write(bytes)
-                bytesRead = len(bytes)
-                callback(bytesRead / sz * 100)
-                if bytesRead < 8192:
-                    break
+            dst = io.open(dstpath, "wb", buffering=0)
+            try:
+                if method == CopyMethod_Reflink and _clone_file(src, dst):
+                    callback(100)
+                    if hash_obj is not None:
+                        # No data passed through, so read the source
+                        _hash_file(srcpath, hash_obj, blocksize=blocksize)
+                else:
+                    buf = bytearray(blocksize)
+                    def progress(offset):
+                        callback(offset / sz * 100)
+                    if not _is_sparse(st) or not _copy_sparse(src, dst,
+                            st.st_size, buf, progress, hash_obj):
+                        _copy_data(src, dst, 0, None, buf, progress, hash_obj)
+            finally:
+                dst.close()
         finally:
             src.close()
-            dst.close()
+
+    if hash_obj is not None and verify:
+        dst_hash_obj = _new_sha1()
+        _hash_file(dstpath, dst_hash_obj, blocksize=blocksize)
+        if dst_hash_obj.digest() != hash_obj.digest():
+            raise ChecksumMismatch(dstpath)
 
     if fs_mode is None:
+        import shutil
         shutil.copystat(srcpath, dstpath)
     else:
         chmod(dstpath, fs_mode)
 
-def copy_file(sourcepath, destpath, callback=no_op, fs_mode=None):
+    if hash_obj is not None:
+        return _get_digest(hash_obj, checksum)
+
+def copy_file(sourcepath, destpath, callback=no_op, fs_mode=None,
+        blocksize=BlockSize_Default, method=CopyMethod_Copy, checksum=None,
+        verify=False):
     """ Copy a file.
+
+    Copying Methods
+    ===============
+    Instead of copying the file's data, CopyMethod_Reflink means to make the
+    destination share the data extents of the source file (copy-on-write),
+    which is possible within a btrfs or XFS filesystem on Linux.
+    CopyMethod_Hardlink means to make the destination a hard link to the source
+    file; the two then share content and mode (so I{fs_mode} can't be
+    specified), which is only safe if neither file is modified afterwards. A
+    destination that is a hard link to the source is replaced rather than
+    written to when copying normally. In both cases,
+    the file is copied normally if the method isn't possible for it (for
+    example, across filesystems).
     @param sourcepath: Source file path.
     @param destpath: Destination file path.
     @param callback: Optional callback to be invoked periodically with progress
     status.
     @param fs_mode: Optionally, specify mode to create destination file with.
+    @param blocksize: Size of blocks to copy the file in. On Linux, the data is
+    copied in the kernel where possible (with copy_file_range or sendfile), one
+    block at a time. Holes in sparse files are reproduced rather than copied,
+    where the system can locate them.
+    @param method: Specify the copying method, see above.
+    @param checksum: Optionally compute the sha1 checksum of the file while
+    copying it, in one of the formats L{Checksum_Hex}, L{Checksum_Binary}.
+    In-kernel copying isn't used then, since the data has to pass through
+    the hash function.
+    @param verify: When computing the checksum, also read back the
+    destination file and check that it has the same checksum.
+    @return: The checksum, if requested.
     @raise MissingSource: Source file is missing.
+    @raise ValueError: Invalid block size or checksum format, I{fs_mode}
+    given for hard linking, or the source and destination are the same file.
+    @raise ChecksumMismatch: The destination file doesn't match.
     raise PermissionsError: Missing filesystem permissions.
     """
-    _copy_file(sourcepath, destpath, callback, fs_mode=fs_mode)
+    return _copy_file(sourcepath, destpath, callback, fs_mode=fs_mode,
+            blocksize=blocksize, method=method, checksum=checksum,
+            verify=verify)
 
 @_raise_permissions
 def remove_file(path, force=False):
@@ -357,7 +2453,7 @@ def remove_file(path, force=False):
     @param force: Force deletion of read-only file?
     @raise PermissionsError: Missing file-permissions.
     """
-    logger.debug("Removing file '%s'" % (path,))
+    logger.debug("Removing file '%s'", path)
     if force:
         # Make the necessary file/directory writeable if it isn't already
         old_mode = get_file_permissions(path)
@@ -367,15 +2463,17 @@ def remove_file(path, force=False):
 
     os.remove(path)
 
-def remove_file_or_dir(path, force=False, recurse=True):
+def remove_file_or_dir(path, force=False, recurse=True, background=False):
     """ Remove a filesystem object, whether it is a file or a directory.
     @param force: On Windows, force deletion of read-only files?
     @param recurse: Delete recursively, if a directory?
+    @param background: Remove a directory in the background (see
+    L{remove_dir})?
     @raise PermissionsError: Missing file-permissions.
     @raise DirNotEmpty: Directory was not empty, and recurse was not specified.
     """
     if os.path.isdir(path):
-        remove_dir(path, force=force, recurse=recurse)
+        remove_dir(path, force=force, recurse=recurse, background=background)
     else:
         remove_file(path, force=force)
 
@@ -385,29 +2483,148 @@ class DestinationExists(SrlError):
 class MissingSource(SrlError):
     pass
 
-CopyDir_New, CopyDir_Delete, CopyDir_Merge = range(3)
-
-class _CopyDirCallback:
-    """ Translate from per-file progress to directory progress. """
-    def __init__(self, total, callback):
+class ChecksumMismatch(SrlError):
+    """ A copied file doesn't have the same checksum as its source.
+    @ivar path: The destination file path.
+    """
+    def __init__(self, path):
+        SrlError.__init__(self, "Checksum mismatch for %s" % (path,))
+        self.path = path
+
+CopyDir_New, CopyDir_Delete, CopyDir_Merge, CopyDir_Sync = range(4)
+CopyProgress_Upfront, CopyProgress_Background = range(2)
+
+# Interval in seconds at which progress is reported while waiting for files
+# that are copied concurrently
+_CopyProgressInterval = 0.1
+# Progress reported at most while the total is still being estimated
+_EstimatedProgressMax = 99.0
+
+class _CopyDirCallback(object):
+    """ Translate from per-file progress to directory progress.
+
+    Each file reports its progress through its own callback, obtained from
+    L{start_file}, so that several files may be copied at once. Progress is
+    normally passed on to the client callback immediately. If deferred, it is
+    only passed on by L{report}, so that the client callback is invoked from
+    the thread driving the copy rather than from the threads copying files.
+
+    The total may be unknown to begin with, in which case it is estimated
+    through L{add_to_total} while copying, until L{end_estimate}. Reported
+    progress is then kept from decreasing, and from reaching 100 before the
+    estimate is complete.
+    @ivar canceled: Set to make file callbacks raise L{Canceled}.
+    """
+    def __init__(self, total, callback, deferred=False):
+        self.__estimating = total is None
+        if total is None:
+            total = 0
         self.__total, self.__callback = (float(total), callback)
-        self.__progress = 0.0
-
-    def __call__(self, progress):
-        self.__callback(self.__progress + progress*self.__cur_mult)
+        self.__deferred = deferred
+        self.__done = 0
+        self.__in_progress = {}
+        self.__reported = self.__max_progress = None
+        self.__lock = threading.Lock()
+        self.canceled = False
 
     def start_file(self, size):
-        if self.__total != 0:
-            self.__cur_mult = size / self.__total
+        """ Start copying a file.
+        @param size: Size of the file.
+        @return: Callback for the file's progress, to pass to L{end_file} when
+        the file is done.
+        """
+        def file_callback(progress):
+            if self.canceled:
+                raise Canceled
+            self.__lock.acquire()
+            try:
+                self.__in_progress[file_callback] = size * progress / 100.0
+                total = self.__get_progress()
+            finally: self.__lock.release()
+            if not self.__deferred:
+                self.__reported = total
+                self.__callback(total)
+
+        file_callback.size = size
+        return file_callback
+
+    def end_file(self, file_callback):
+        self.__lock.acquire()
+        try:
+            self.__in_progress.pop(file_callback, None)
+            self.__done += file_callback.size
+        finally: self.__lock.release()
+
+    def add_to_total(self, size):
+        """ Add to the estimated total. """
+        self.__lock.acquire()
+        try: self.__total += size
+        finally: self.__lock.release()
+
+    def end_estimate(self):
+        """ Mark the estimated total as complete. """
+        self.__lock.acquire()
+        try: self.__estimating = False
+        finally: self.__lock.release()
+
+    def finish(self):
+        """ All files are done, make the total final and report it. """
+        self.__lock.acquire()
+        try:
+            # The tree may have changed since the total was counted
+            self.__total = float(self.__done)
+            self.__estimating = False
+        finally: self.__lock.release()
+        self.report()
+
+    def report(self):
+        """ Pass on deferred progress to the client callback, if changed. """
+        self.__lock.acquire()
+        try: total = self.__get_progress()
+        finally: self.__lock.release()
+        if total != self.__reported:
+            self.__reported = total
+            self.__callback(total)
+
+    def __get_progress(self):
+        # Sizes of finished files are summed exactly, so that progress ends at
+        # 100 regardless of the order files finish in
+        progress = self.__done + sum(self.__in_progress.values())
+        if self.__max_progress is None and not self.__estimating:
+            if self.__total == 0:
+                return 0.0
+            return progress / self.__total * 100
+
+        # The total is or was estimated, copying may have got ahead of it
+        if self.__estimating:
+            progress = min(progress / max(self.__total, progress, 1) * 100,
+                    _EstimatedProgressMax)
+        elif self.__total != 0:
+            progress = progress / self.__total * 100
         else:
-            self.__cur_mult = 0
-
-    def end_file(self):
-        self.__progress += 100 * self.__cur_mult
+            progress = 100.0
+        self.__max_progress = max(progress, self.__max_progress)
+        return self.__max_progress
+
+class CopyDirResult(object):
+    """ The outcome of L{copy_dir}.
+
+    Paths are relative to the source (or destination) directory.
+    @ivar copied: Files (and symlinks) that were copied.
+    @ivar skipped: Files that were already up to date (with CopyDir_Sync).
+    @ivar deleted: Extraneous destination entries that were deleted (with
+    CopyDir_Sync).
+    @ivar checksums: Checksums of copied files by path, if requested.
+    """
+    def __init__(self):
+        self.copied, self.skipped, self.deleted = [], [], []
+        self.checksums = {}
 
 @_raise_permissions
 def copy_dir(sourcedir, destdir, callback=no_op, ignore=[], mode=CopyDir_New,
-        copyfile=None, fs_mode=None):
+        copyfile=None, fs_mode=None, workers=None,
+        progress=CopyProgress_Upfront, sync_checksum=False, sync_delete=False,
+        method=CopyMethod_Copy, checksum=None, verify=False):
     """ Copy a directory and its contents.
 
     Custom File Copying
@@ -419,47 +2636,87 @@ def copy_dir(sourcedir, destdir, callback=no_op, ignore=[], mode=CopyDir_New,
 
     The callback should be called periodically during copying, with progress
     percentage as a float.
+
+    Synchronizing
+    =============
+    With CopyDir_Sync, a destination file is left alone if it has the same size
+    and modification time as the source file, or optionally the same checksum.
+    Directories that exist in the destination are kept, other destination
+    entries are replaced. Modification times are copied to the destination
+    files, so that they are found up to date next time. Optionally, destination
+    entries that don't exist in the source directory (and aren't ignored) are
+    deleted.
     @param sourcedir: Source directory.
     @param destdir: Destination directory.
     @param callback: Optional callback to be invoked periodically with progress
     status. Raise L{Canceled} from this to cancel.
-    @param ignore: Optional list of filename glob patterns to ignore.
+    @param ignore: Optional list of filename glob patterns to ignore, or an
+    L{IgnoreMatcher}.
     @param mode: Specify the copying mode. CopyDir_New means to refuse copying
     onto an existing directory, CopyDir_Delete means delete existing
     destination, CopyDir_Merge means copying contents of source directory into
-    destination directory.
+    destination directory, CopyDir_Sync means only copying what differs (see
+    above).
     @param copyfile: Optionally supply a custom function for copying individual
     files.
     @param fs_mode: The numeric mode to create files/directories with.
+    @param method: Specify the method for copying files, see L{copy_file}.
+    Doesn't apply to a custom I{copyfile} function. I{fs_mode} can't be
+    combined with CopyMethod_Hardlink.
+    @param workers: Optionally copy files, and traverse the source directory,
+    with this many threads (see L{walkdir}). The callback is still only
+    invoked from the calling thread, whereas a custom I{copyfile} function is
+    invoked from the worker threads.
+    @param progress: Specify how progress is computed. CopyProgress_Upfront
+    means to add up the size of the source tree before copying anything,
+    CopyProgress_Background means to start copying immediately while the size
+    is added up in a background thread. Progress is then estimated until the
+    size is known, but never decreases.
+    @param sync_checksum: With CopyDir_Sync, compare the checksums of files
+    with equal size instead of their modification times.
+    @param sync_delete: With CopyDir_Sync, delete extraneous destination
+    entries.
+    @param checksum: Optionally compute the sha1 checksums of the files while
+    copying them, in one of the formats L{Checksum_Hex}, L{Checksum_Binary}
+    (see L{copy_file}). A custom I{copyfile} function is not involved in
+    this, the source file is read afterwards instead.
+    @param verify: When computing checksums, also read back the destination
+    files and check that they match.
+    @return: L{CopyDirResult}.
     @raise MissingSource: The source directory doesn't exist.
     @raise DirectoryExists: The destination directory already exists (and
     mode is CopyDir_New).
     @raise PermissionsError: Missing permission to perform operation.
     @raise Canceled: The callback requested canceling.
+    @raise ChecksumMismatch: A destination file doesn't match.
+    @raise ValueError: Invalid checksum format, or I{fs_mode} given for hard
+    linking.
     """
+    if checksum not in (None, Checksum_Hex, Checksum_Binary):
+        raise ValueError("Invalid checksum format")
+    if method == CopyMethod_Hardlink and fs_mode is not None and \
+            copyfile is None:
+        raise ValueError("A mode can't be specified for hard links")
     if os.path.exists(destdir):
         if mode == CopyDir_New:
             raise DestinationExists(destdir)
         elif mode == CopyDir_Delete:
             remove_file_or_dir(destdir)
 
-    def filter(names):
-        """ Filter list of filesystem names in-place. When using os.walk,
-        directories removed from the list won't be traversed. """
-        for ptrn in ignore:
-            for name in names[:]:
-                if fnmatch.fnmatch(name, ptrn):
-                    names.remove(name)
-        return names
+    if not isinstance(ignore, IgnoreMatcher):
+        ignore = IgnoreMatcher(ignore)
+
+    is_windows = get_os_name() == Os_Windows
 
     def update_mode(src, dst):
         """Potentially copy mode from source to destination."""
-        if get_os_name() == Os_Windows:
+        if is_windows:
             # Won't work on Windows
             return
 
         if fs_mode is None:
             # Only copy if mode isn't already specified
+            import shutil
             shutil.copystat(src, dst)
 
     if not os.path.exists(sourcedir):
@@ -473,44 +2730,197 @@ def copy_dir(sourcedir, destdir, callback=no_op, ignore=[], mode=CopyDir_New,
         os.makedirs(destdir, **mkdir_kwds)
     update_mode(sourcedir, destdir)
 
-    # We figure out the total number of bytes, for computing progress
-    allbytes = 0
-    for dpath, dnames, fnames in walkdir(sourcedir):
-        for d in filter(dnames):
-            allbytes += 1
-        for f in filter(fnames):
-            allbytes += os.lstat(os.path.join(dpath, f)).st_size
+    def count_bytes(walker):
+        """ Yield the number of bytes to copy per directory, counting
+        subdirectories as one byte each. """
+        for dpath, dentries, fentries in walker:
+            nbytes = len(dentries)
+            for entry in fentries:
+                nbytes += entry.stat(follow_symlinks=False).st_size
+            yield nbytes
+
+    def count_bytes_background():
+        counts = count_bytes(walkdir(sourcedir, entries=True, ignore=ignore))
+        try:
+            for nbytes in counts:
+                if stop_counting.is_set():
+                    return
+                mycallback.add_to_total(nbytes)
+        except (EnvironmentError, SrlError):
+            # Copying will run into the same error
+            return
+        finally: counts.close()
+        mycallback.end_estimate()
 
-    if copyfile is None:
-        copyfile = _copy_file
-    mycallback = _CopyDirCallback(allbytes, callback)
+    if progress == CopyProgress_Upfront:
+        # We figure out the total number of bytes, for computing progress
+        allbytes = sum(count_bytes(walkdir(sourcedir, entries=True,
+            ignore=ignore, workers=workers)))
+    else:
+        allbytes = None
+
+    custom_copyfile = copyfile is not None
+    if not custom_copyfile:
+        copyfile = functools.partial(_copy_file, method=method,
+                checksum=checksum, verify=verify)
+    pool = None
+    if workers and workers > 1:
+        import Queue
+        pool, done, in_flight = _ThreadPool(workers), Queue.Queue(), set()
+    mycallback = _CopyDirCallback(allbytes, callback,
+            deferred=pool is not None)
+    if allbytes is None:
+        stop_counting = threading.Event()
+        counter = threading.Thread(target=count_bytes_background,
+                name="srllib copy_dir counter")
+        counter.daemon = True
+        counter.start()
+
+    def is_up_to_date(entry, dstpath):
+        """ Is a destination file in sync with the source file? """
+        try: dst_st = os.lstat(dstpath)
+        except OSError:
+            return False
+        src_st = entry.stat(follow_symlinks=False)
+        if not stat.S_ISREG(dst_st.st_mode) or dst_st.st_size != \
+                src_st.st_size:
+            return False
+        if sync_checksum:
+            if get_checksum(entry.path) != get_checksum(dstpath):
+                return False
+        elif int(dst_st.st_mtime) != int(src_st.st_mtime):
+            return False
+        if fs_mode is None and stat.S_IMODE(dst_st.st_mode) != \
+                stat.S_IMODE(src_st.st_mode):
+            os.chmod(dstpath, stat.S_IMODE(src_st.st_mode))
+        return True
 
-    # First invoke the callback with a progress of 0
-    callback(0)
-    for dpath, dnames, fnames in walkdir(sourcedir):
-        for d in filter(dnames):
-            srcpath = os.path.join(dpath, d)
-            dstpath = replace_root(srcpath, destdir, sourcedir)
-            if os.path.exists(dstpath):
-                remove_file_or_dir(dstpath)
-            os.mkdir(dstpath, **mkdir_kwds)
-            update_mode(srcpath, dstpath)
-            mycallback.start_file(1)
-            mycallback(100)
-            mycallback.end_file()
-        for f in filter(fnames):
-            srcpath = os.path.join(dpath, f)
-            dstpath = replace_root(srcpath, destdir, sourcedir)
-            if os.path.exists(dstpath):
-                remove_file_or_dir(dstpath)
-            if hasattr(os, "symlink") and os.path.islink(srcpath):
-                linktgt = os.readlink(srcpath)
-                os.symlink(linktgt, dstpath)
-                continue
+    def remove_dst(dstpath):
+        """ Remove destination entry, without following symlinks. """
+        if os.path.isdir(dstpath) and not os.path.islink(dstpath):
+            remove_dir(dstpath)
+        else:
+            remove_file(dstpath)
+
+    def copy(entry, dstpath, relpath, size):
+        """ Copy a file.
+        @return: relpath, whether the file was copied and its checksum.
+        """
+        file_callback = mycallback.start_file(size)
+        if mode == CopyDir_Sync and is_up_to_date(entry, dstpath):
+            file_callback(100)
+            mycallback.end_file(file_callback)
+            return relpath, False, None
+
+        if os.path.lexists(dstpath):
+            remove_dst(dstpath)
+        digest = copyfile(entry.path, dstpath, file_callback, fs_mode=fs_mode)
+        if checksum is not None and custom_copyfile:
+            digest = get_checksum(entry.path, format=checksum)
+            if verify and get_checksum(dstpath, format=checksum) != digest:
+                raise ChecksumMismatch(dstpath)
+        if mode == CopyDir_Sync:
+            src_st = entry.stat(follow_symlinks=False)
+            os.utime(dstpath, (src_st.st_atime, src_st.st_mtime))
+        mycallback.end_file(file_callback)
+        return relpath, True, digest
+
+    def record(copy_result):
+        relpath, copied, digest = copy_result
+        if copied:
+            result.copied.append(relpath)
+            if checksum is not None:
+                result.checksums[relpath] = digest
+        else:
+            result.skipped.append(relpath)
 
-            mycallback.start_file(os.lstat(srcpath).st_size)
-            copyfile(srcpath, dstpath, mycallback, fs_mode=fs_mode)
-            mycallback.end_file()
+    def wait_for_copy():
+        """ Wait for a file copy to finish, while reporting progress. """
+        try: task = done.get(timeout=_CopyProgressInterval)
+        except Queue.Empty: pass
+        else:
+            in_flight.discard(task)
+            record(task.get_result())
+        mycallback.report()
+
+    result = CopyDirResult()
+    rebaser = PathRebaser(sourcedir, destdir)
+    # Length of directory prefixes, to strip for relative paths
+    prefix_len = len(os.path.join(sourcedir, ""))
+    dst_prefix_len = len(rebaser.rebase_relative(""))
+    # First invoke the callback with a progress of 0
+    mycallback.report()
+    try:
+        for dpath, dentries, fentries in walkdir(sourcedir, entries=True,
+                ignore=ignore, workers=workers):
+            if mode == CopyDir_Sync and sync_delete:
+                dst_dpath = rebaser.rebase(dpath)
+                names = set([e.name for e in dentries + fentries])
+                for entry in sorted(_scan_dir(dst_dpath), key=_get_entry_name):
+                    relpath = entry.path[dst_prefix_len:]
+                    if entry.name in names or ignore.match(entry.name,
+                            entry.is_dir(), relpath):
+                        continue
+                    remove_dst(entry.path)
+                    result.deleted.append(relpath)
+
+            for entry, dstpath in zip(dentries, rebaser.rebase_many([e.path for
+                    e in dentries])):
+                srcpath = entry.path
+                if mode == CopyDir_Sync:
+                    # Keep existing directories
+                    if os.path.islink(dstpath) or (os.path.lexists(dstpath)
+                            and not os.path.isdir(dstpath)):
+                        remove_dst(dstpath)
+                elif os.path.exists(dstpath):
+                    remove_file_or_dir(dstpath)
+                if not os.path.isdir(dstpath):
+                    os.mkdir(dstpath, **mkdir_kwds)
+                update_mode(srcpath, dstpath)
+                file_callback = mycallback.start_file(1)
+                file_callback(100)
+                mycallback.end_file(file_callback)
+            for entry in fentries:
+                srcpath = entry.path
+                relpath = srcpath[prefix_len:]
+                dstpath = rebaser.rebase_relative(relpath)
+                size = entry.stat(follow_symlinks=False).st_size
+                if hasattr(os, "symlink") and entry.is_symlink():
+                    linktgt = os.readlink(srcpath)
+                    if mode == CopyDir_Sync and os.path.islink(dstpath) and \
+                            os.readlink(dstpath) == linktgt:
+                        result.skipped.append(relpath)
+                    else:
+                        if os.path.lexists(dstpath):
+                            remove_dst(dstpath)
+                        os.symlink(linktgt, dstpath)
+                        result.copied.append(relpath)
+                    file_callback = mycallback.start_file(size)
+                    file_callback(100)
+                    mycallback.end_file(file_callback)
+                    continue
+
+                if pool is None:
+                    record(copy(entry, dstpath, relpath, size))
+                    continue
+                in_flight.add(pool.submit(copy, entry, dstpath, relpath, size,
+                    notify=done))
+                while len(in_flight) >= workers * 2:
+                    wait_for_copy()
+
+        if pool is not None:
+            while in_flight:
+                wait_for_copy()
+        mycallback.finish()
+    finally:
+        if allbytes is None:
+            stop_counting.set()
+        if pool is not None:
+            # Stop copies still in progress, in case of error
+            mycallback.canceled = True
+            pool.close()
+
+    return result
 
 def create_tempfile(suffix="", prefix="tmp", close=True, content=None,
         encoding=None, dir=None):
@@ -537,6 +2947,7 @@ def create_tempfile(suffix="", prefix="tmp", close=True, content=None,
             if encoding is None:
                 f = file(fname, "w+")
             else:
+                import codecs
                 f = codecs.open(fname, "w+", encoding)
             try:
                 if content:
@@ -572,6 +2983,7 @@ def create_file(name, content="", binary=False, encoding=None, close=True):
     if encoding is None:
         f = file(name, mode)
     else:
+        import codecs
         f = codecs.open(name, mode, encoding)
     try:
         if content:
@@ -598,6 +3010,7 @@ def read_file(name, binary=False, encoding=None):
     if encoding is None:
         f = file(name, mode)
     else:
+        import codecs
         f = codecs.open(name, mode=mode, encoding=encoding)
     try: content = f.read()
     finally: f.close()
@@ -608,140 +3021,479 @@ def _sig(st):
     return (stat.S_IFMT(st.st_mode), st.st_size, stat.S_IMODE(st.st_mode),
             st.st_uid, st.st_gid)
 
-def compare_dirs(dir0, dir1, shallow=True, ignore=[], filecheck_func=None):
+def _read_block(f, offset, buf):
+    """ Read into buffer at an offset, until full or end of file.
+    @return: The number of bytes read.
+    """
+    f.seek(offset)
+    view = memoryview(buf)
+    num = 0
+    while num < len(buf):
+        read = f.readinto(view[num:])
+        if not read:
+            break
+        num += read
+    return num
+
+def compare_files(path0, path1, blocksize=BlockSize_Default):
+    """ Check whether two files have the same content.
+
+    The comparison is tiered, so as to stop as early as possible: First the
+    sizes are compared, then the first and last blocks, then the rest of the
+    files block by block until the first difference.
+    @param blocksize: Size of blocks to compare.
+    @raise ValueError: Invalid block size.
+    """
+    _check_blocksize(blocksize)
+    st0, st1 = os.stat(path0), os.stat(path1)
+    if st0.st_size != st1.st_size:
+        return False
+    if (st0.st_dev, st0.st_ino) == (st1.st_dev, st1.st_ino):
+        # The same file
+        return True
+    size = st0.st_size
+    if size == 0:
+        return True
+
+    f0 = io.open(path0, "rb", buffering=0)
+    try:
+        f1 = io.open(path1, "rb", buffering=0)
+        try:
+            buf0, buf1 = bytearray(blocksize), bytearray(blocksize)
+
+            def compare_block(offset):
+                num0, num1 = _read_block(f0, offset, buf0), _read_block(f1,
+                        offset, buf1)
+                if num0 != num1:
+                    return False
+                if num0 == blocksize:
+                    return buf0 == buf1
+                return buf0[:num0] == buf1[:num1]
+
+            # The ends of files tend to differ if anything, e.g. for
+            # appended files
+            last = max((size - 1) // blocksize * blocksize, 0)
+            if not compare_block(0) or (last > 0 and not compare_block(last)):
+                return False
+            for offset in xrange(blocksize, last, blocksize):
+                if not compare_block(offset):
+                    return False
+            return True
+        finally:
+            f1.close()
+    finally:
+        f0.close()
+
+class DirDiff(object):
+    """ Differences between two directory trees, as relative paths.
+
+    The contents of directories only found in one tree, or of different types,
+    are not listed.
+    @ivar added: Entries only in the second tree.
+    @ivar removed: Entries only in the first tree.
+    @ivar type_changed: Entries of different types (e.g., file and directory).
+    @ivar metadata_changed: Entries with different size, permissions or
+    ownership (directories are not compared by size).
+    @ivar content_changed: Files (or symlinks) with the same metadata but
+    different content.
+    @ivar errors: Entries that couldn't be compared.
+    """
+    def __init__(self):
+        self.added, self.removed, self.type_changed, self.metadata_changed, \
+                self.content_changed, self.errors = [], [], [], [], [], []
+
+    def __nonzero__(self):
+        """ Are there any differences (or errors)? """
+        return bool(self.added or self.removed or self.type_changed or
+                self.metadata_changed or self.content_changed or self.errors)
+
+    def __repr__(self):
+        return "<DirDiff added=%r removed=%r type_changed=%r " \
+                "metadata_changed=%r content_changed=%r errors=%r>" % (
+                        self.added, self.removed, self.type_changed,
+                        self.metadata_changed, self.content_changed,
+                        self.errors)
+
+def _get_filecheck_func(filecheck_func, cache):
+    if filecheck_func is not None:
+        return filecheck_func
+    if cache is None:
+        return compare_files
+
+    def compare_checksums(path0, path1):
+        return get_checksum(path0, format=Checksum_Binary, cache=cache) == \
+                get_checksum(path1, format=Checksum_Binary, cache=cache)
+    return compare_checksums
+
+def diff_dirs(dir0, dir1, shallow=True, ignore=None, filecheck_func=None,
+        cache=None, workers=None, descend_mismatched=True):
+    """ Find the differences between two directory trees.
+
+    Both trees are scanned in one pass: each directory of the first tree is
+    listed along with its counterpart in the second, and entries are matched
+    by name through a dictionary. Matching entries are compared by type, then
+    by metadata (see L{compare_dirs}), then optionally by content.
+    @param dir0: The first directory.
+    @param dir1: The second directory.
+    @param shallow: Don't compare the contents of files?
+    @param ignore: Names of files(/directories) to ignore, or an
+    L{IgnoreMatcher}.
+    @param filecheck_func: Optionally provide function for deciding whether
+    two files are alike. By default, L{compare_files} is used.
+    @param cache: Optionally supply a L{ChecksumCache}; files are then
+    compared by checksum, reusing those of unmodified files.
+    @param workers: Optionally compare file contents in a pool of this many
+    threads.
+    @param descend_mismatched: Also compare the contents of directories whose
+    metadata differ?
+    @return: L{DirDiff}.
+    @raise ValueError: One of the directories are missing.
+    """
+    return _diff_dirs(dir0, dir1, shallow, ignore, filecheck_func, cache,
+            workers, descend_mismatched, None)
+
+def _diff_dirs(dir0, dir1, shallow, ignore, filecheck_func, cache, workers,
+        descend_mismatched, order):
+    """ Implementation of L{diff_dirs}.
+    @param order: Optionally a list, receiving each difference as a pair of
+    the L{DirDiff} list it belongs to and its path, in traversal order.
+    """
+    if not os.path.exists(dir0):
+        raise ValueError("First directory missing: '%s'" % (dir0,))
+    if not os.path.exists(dir1):
+        raise ValueError("Second directory missing: '%s'" % (dir1,))
+    filecheck_func = _get_filecheck_func(filecheck_func, cache)
+
+    diff = DirDiff()
+    prefix_len = len(os.path.join(dir0, ""))
+    is_ignored1 = _get_ignore_filter(ignore, dir1)
+    # File contents are compared after traversing, if in parallel
+    pool_compare = workers is not None and workers > 1
+    to_compare = []
+
+    def record(category, relpath):
+        category.append(relpath)
+        if order is not None:
+            order.append((category, relpath))
+
+    def handle_err(dpath):
+        record(diff.errors, dpath[prefix_len:] or os.curdir)
+        # Don't traverse this directory
+        return False
+
+    for dpath, dentries, fentries in walkdir(dir0, handle_err, ignore=ignore,
+            sort=True, entries=True):
+        reldir = dpath[prefix_len:]
+        try:
+            entries1 = dict([(e.name, e) for e in _scan_dir(os.path.join(dir1,
+                reldir)) if is_ignored1 is None or not is_ignored1(e)])
+        except EnvironmentError:
+            record(diff.errors, reldir or os.curdir)
+            del dentries[:]
+            continue
+
+        traverse = []
+        for entry in dentries + fentries:
+            relpath = os.path.join(reldir, entry.name)
+            entry1 = entries1.pop(entry.name, None)
+            if entry1 is None:
+                record(diff.removed, relpath)
+                continue
+            try:
+                st0, st1 = (entry.stat(follow_symlinks=False), entry1.stat(
+                    follow_symlinks=False))
+                if stat.S_IFMT(st0.st_mode) != stat.S_IFMT(st1.st_mode):
+                    record(diff.type_changed, relpath)
+                    continue
+
+                sig0, sig1 = _sig(st0), _sig(st1)
+                if stat.S_ISDIR(st0.st_mode):
+                    # Ignore size
+                    if sig0[2:] != sig1[2:]:
+                        record(diff.metadata_changed, relpath)
+                        if not descend_mismatched:
+                            continue
+                    traverse.append(entry)
+                elif sig0 != sig1:
+                    record(diff.metadata_changed, relpath)
+                elif shallow:
+                    pass
+                elif stat.S_ISLNK(st0.st_mode):
+                    if os.readlink(entry.path) != os.readlink(entry1.path):
+                        record(diff.content_changed, relpath)
+                elif pool_compare:
+                    # Keep the place of the result in the traversal order
+                    if order is not None:
+                        order.append(None)
+                        to_compare.append((relpath, entry.path, entry1.path,
+                            len(order) - 1))
+                    else:
+                        to_compare.append((relpath, entry.path, entry1.path,
+                            None))
+                elif not filecheck_func(entry.path, entry1.path):
+                    record(diff.content_changed, relpath)
+            except EnvironmentError:
+                record(diff.errors, relpath)
+
+        for name in sorted(entries1):
+            record(diff.added, os.path.join(reldir, name))
+        dentries[:] = traverse
+
+    def check_contents(item):
+        relpath, path0, path1, index = item
+        try: return filecheck_func(path0, path1)
+        except EnvironmentError:
+            return None
+
+    if to_compare:
+        for item, alike in zip(to_compare, _parallel_imap(check_contents,
+                to_compare, workers)):
+            relpath, index = item[0], item[3]
+            if alike is None:
+                category = diff.errors
+            elif not alike:
+                category = diff.content_changed
+            else:
+                continue
+            category.append(relpath)
+            if index is not None:
+                order[index] = (category, relpath)
+        if order is not None:
+            order[:] = [item for item in order if item is not None]
+
+    return diff
+
+def compare_dirs(dir0, dir1, shallow=True, ignore=[], filecheck_func=None,
+        cache=None, workers=None):
     """ Check that the contents of two directories match.
 
     Contents that mismatch and content that can't be found in one directory or
-    can't be checked somehow are returned separately.
+    can't be checked somehow are returned separately, in traversal order.
+    Entries are mismatched if their type, size (except for directories),
+    permissions or ownership differ, or (if not shallow) their content. The
+    contents of mismatched directories are not considered. See L{diff_dirs}
+    for a more detailed result.
     @param shallow: Just check the stat signature instead of reading content
-    @param ignore: Names of files(/directories) to ignore
+    @param ignore: Names of files(/directories) to ignore, or an
+    L{IgnoreMatcher}
     @param filecheck_func: Optionally provide function for deciding whether
-    two files are alike.
+    two files are alike. By default, L{compare_files} is used.
+    @param cache: Optionally supply a L{ChecksumCache}, for reusing checksums
+    of unmodified files when not shallow. Files are then compared by checksum
+    instead of by content.
+    @param workers: Optionally compare file contents in a pool of this many
+    threads.
     @raise ValueError: One of the directories are missing.
     @return: Pair of mismatched and failed pathnames, respectively
     """
-    def checkfiles(path0, path1):
-        chksum0, chksum1 = (get_checksum(path0, format=Checksum_Binary),
-            get_checksum(path1, format=Checksum_Binary))
-        r = chksum0 == chksum1
-        if not r:
-            sys.stderr.write("%s mismatched against %s because %s != %s\n" %
-                    (path0, path1, chksum0, chksum1))
-        return r
-
-    if filecheck_func is None:
-        filecheck_func = checkfiles
-    mismatch = []
-    error = []
     if not os.path.exists(dir0):
         raise ValueError("First directory missing: '%s'" % (dir0,))
     if not os.path.exists(dir1):
         raise ValueError("Second directory missing: '%s'" % (dir1,))
     if len(os.listdir(dir0)) == 0:
         # Indicate any files in dir1 as erroneus
-        return mismatch, os.listdir(dir1)
+        return [], os.listdir(dir1)
+
+    order = []
+    diff = _diff_dirs(dir0, dir1, shallow, ignore, filecheck_func, cache,
+            workers, False, order)
+    mismatch, error = [], []
+    for category, relpath in order:
+        if category is diff.removed or category is diff.added or category is \
+                diff.errors:
+            error.append(relpath)
+        else:
+            mismatch.append(relpath)
+    return mismatch, error
 
-    if dir0[-1] != os.path.sep:
-        dir0 = dir0 + os.path.sep
+class _TreeChmodder(object):
+    """ Changes the permissions of directory trees.
 
-    def handle_err(dpath):
-        # Don't traverse this directory
-        return False
-    for dpath, dnames, fnames in walkdir(dir0, handle_err):
-
-        # Filter out files to ignore
-        for ign in ignore:
-            while ign in dnames:
-                dnames.remove(ign)
-            while ign in fnames:
-                fnames.remove(ign)
-
-        reldir = dpath[len(dir0):]
-        assert reldir != dpath, dpath
-
-        contents0 = dnames + fnames
-        contents1 = [e for e in os.listdir(os.path.join(dir1, reldir)) if e not
-            in ignore]
-
-        lnth0, lnth1 = len(contents0), len(contents1)
-        if lnth0 < lnth1:
-            for name in contents1:
-                if name not in contents0:
-                    error.append(os.path.join(reldir, name))
-
-        for name in contents0:
-            relpath = os.path.join(reldir, name)
-            try:
-                path0, path1 = os.path.join(dir0, relpath), os.path.join(dir1,
-                        relpath)
-                st0, st1 = os.lstat(path0), os.lstat(path1)
-                mismatched = False
-                s0, s1 = _sig(st0), _sig(st1)
-                if name in fnames:
-                    if s0 != s1:
-                        sys.stderr.write("%s mismatched because %r != %r\n" %
-                                (path1, s0, s1))
-                        mismatched = True
-                    elif not shallow:
-                        mismatched = not filecheck_func(path0, path1)
+    Each directory is listed once, and its files are modified relative to a
+    file descriptor for the directory where supported. Directories are kept
+    traversable while their contents are processed, and get their final mode
+    once their subdirectories are done.
+    """
+    def __init__(self, mode):
+        self.__mode = mode
+        # Make directories accessible in the meantime
+        self.__dmode = mode | stat.S_IREAD | stat.S_IEXEC
+        if hasattr(os, "fchmod"):
+            self.__chmodat = _get_dir_fd_function("chmod")
+        else:
+            self.__chmodat = None
+
+    def chmod(self, path, workers=None):
+        _process_tree(_TreeNode(path, stat.S_IMODE(os.stat(path).st_mode),
+            None), self.__process_dir, self.__finish_dir, workers)
+
+    def __process_dir(self, node):
+        dpath = node.path
+        if node.parent is None and not node.mode & stat.S_IREAD:
+            # The tree must be readable to begin with
+            raise PermissionsError(dpath)
+        traversable = stat.S_IREAD | stat.S_IEXEC
+        if node.mode & traversable != traversable:
+            # Make the directory traversable before listing it
+            self.__chmod_dir(None, node, self.__dmode)
+
+        subdirs, fnames = [], []
+        for entry in _scan_dir(dpath):
+            # Stat errors are raised, rather than taking directories for
+            # files
+            mode = entry.stat(follow_symlinks=False).st_mode
+            if stat.S_ISDIR(mode):
+                subdirs.append(_TreeNode(entry.path, stat.S_IMODE(mode), node))
+            elif not stat.S_ISLNK(mode):
+                # Symlinks are skipped, since changing their mode would change
+                # that of their targets, which may lie outside the tree
+                fnames.append(entry.name)
+
+        dirfd = None
+        if fnames and self.__chmodat is not None:
+            dirfd = _open_dir(dpath)
+        try:
+            for fname in fnames:
+                if dirfd is not None:
+                    self.__chmodat(dirfd, fname, self.__mode)
                 else:
-                    assert name in dnames
-                    mismatched = s0[2:] != s1[2:]   # Ignore format and size
-                    if mismatched:
-                        # No need to traverse this directory
-                        sys.stderr.write("Mismatched: %r, %r\n" % (s0[1:],
-                            s1[1:]))
-                        dnames.remove(name)
-                if mismatched:
-                    mismatch.append(relpath)
-            except OSError:
-                if name in dnames:
-                    dnames.remove(name)
-                error.append(relpath)
+                    os.chmod(os.path.join(dpath, fname), self.__mode)
+            if not subdirs:
+                self.__chmod_dir(dirfd, node, self.__mode)
+        finally:
+            if dirfd is not None:
+                os.close(dirfd)
+        return subdirs
 
-    return mismatch, error
+    def __finish_dir(self, node):
+        self.__chmod_dir(None, node, self.__mode)
+
+    def __chmod_dir(self, dirfd, node, mode):
+        if node.mode == mode:
+            return
+        if dirfd is not None:
+            os.fchmod(dirfd, mode)
+        else:
+            os.chmod(node.path, mode)
+        node.mode = mode
 
 @_raise_permissions
-def chmod(path, mode, recursive=False):
+def chmod(path, mode, recursive=False, workers=None):
     """ Wrapper around os.chmod, which allows for recursive modification of a
     directory tree.
+
+    When recursive, each directory is only listed once. Directories are made
+    temporarily traversable if the mode doesn't allow it. Symlinks within the
+    tree are left alone, rather than modifying their targets.
     @param path: Path to modify.
     @param mode: New permissions mode.
     @param recursive: Apply recursively, if directory?
+    @param workers: Optionally modify independent subtrees concurrently, with
+    this many threads.
     @raise PermissionsError: Missing file-permissions.
     """
-    made_exec = []
+    if recursive and os.path.isdir(path):
+        _TreeChmodder(mode).chmod(path, workers=workers)
+    else:
+        os.chmod(path, mode)
 
-    def _chmod(path, fixexec=False):
-        newmode = mode
-        if fixexec and os.path.isdir(path) and not mode & stat.S_IEXEC:
-            # Make the directory accessible
-            newmode |= stat.S_IEXEC
-            made_exec.append(path)
+# Minimum number of seconds between checks of the PATH directories for
+# modifications, by resolve_path
+_PathIndexCheckInterval = 1.0
 
-        os.chmod(path, newmode)
+class _ExecutableIndex(object):
+    """ Index of the files in the PATH directories, for L{resolve_path}.
 
-    if recursive and os.path.isdir(path):
-        seen = set()
-        for dpath, dnames, fnames in walkdir(path):
-            assert dpath not in seen, "Already entered %s" % (dpath,)
-            seen.add(dpath)
-            _chmod(dpath, fixexec=True)
-
-            for d in dnames[:]:
-                # Chmod empty dirs now
-                os.listdir(os.path.join(dpath, d))
-                if not os.listdir(os.path.join(dpath, d)):
-                    _chmod(os.path.join(dpath, d))
-                    dnames.remove(d)
-            for f in fnames:
-                _chmod(os.path.join(dpath, f))
-
-        # Now finalize the executable bit in depth-first fashion
-        for dpath in reversed(made_exec):
-            _chmod(dpath)
-    else:
-        _chmod(path)
+    The index is rebuilt when PATH changes. A directory is listed anew when
+    its modification time changes, which is checked at most every
+    L{_PathIndexCheckInterval} seconds and whenever an executable isn't found.
+    Resolved paths are cached until a directory changes. Relative PATH
+    directories depend on the working directory, so they aren't indexed but
+    searched every time.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__path_env = None
+        # Lists of directory path, modification time and file names
+        self.__dirs = []
+        self.__resolved = {}
+        self.__checked = 0
+
+    def resolve(self, executables, exts):
+        """ Resolve executables into absolute paths.
+        @param exts: Extensions to try for each executable, in order.
+        @raise NotFound: An executable was not found.
+        """
+        self.__lock.acquire()
+        try:
+            path_env = os.environ.get("PATH", "")
+            if path_env != self.__path_env:
+                self.__path_env = path_env
+                self.__dirs = [[d, -1, None] for d in path_env.split(
+                    os.pathsep)]
+                self.__resolved.clear()
+                self.__check()
+            elif time.time() - self.__checked >= _PathIndexCheckInterval:
+                self.__check()
+
+            exepaths = []
+            for executable in executables:
+                key = (executable, exts)
+                exepath = self.__resolved.get(key)
+                if exepath is None:
+                    exepath, cacheable = self.__find(executable, exts)
+                    if exepath is None:
+                        # The index may be stale
+                        self.__check()
+                        exepath, cacheable = self.__find(executable, exts)
+                        if exepath is None:
+                            raise NotFound(executable)
+                    if cacheable:
+                        self.__resolved[key] = exepath
+                exepaths.append(exepath)
+            return exepaths
+        finally:
+            self.__lock.release()
+
+    def __check(self):
+        """ List directories that have been modified. """
+        self.__checked = time.time()
+        for entry in self.__dirs:
+            dpath = entry[0]
+            if not os.path.isabs(dpath):
+                continue
+            try: mtime = os.stat(dpath).st_mtime
+            except EnvironmentError:
+                mtime = None
+            if mtime == entry[1]:
+                continue
+
+            entry[1] = mtime
+            try: entry[2] = frozenset([os.path.normcase(n) for n in
+                os.listdir(dpath)])
+            except EnvironmentError:
+                entry[2] = frozenset()
+            self.__resolved.clear()
+
+    def __find(self, executable, exts):
+        """ Find an executable in the PATH directories.
+        @return: Pair of executable path (or None) and whether it may be
+        cached.
+        """
+        for dpath, mtime, names in self.__dirs:
+            for ext in exts:
+                fname = executable + ext
+                if names is not None and os.path.normcase(fname) not in names:
+                    continue
+                exepath = os.path.join(dpath, fname)
+                try:
+                    if os.access(exepath, os.X_OK):
+                        return exepath, names is not None
+                except OSError:
+                    pass
+        return None, False
+
+_executable_index = _ExecutableIndex()
 
 def resolve_path(executable):
     """Resolve name of executable into absolute path.
@@ -751,44 +3503,52 @@ def resolve_path(executable):
     the executable doesn't have one of the possible extensions
     of an executable, as defined in $PATHEXTS, we will search the path for a
     combination of the filename and any extension in $PATHEXTS (e.g., .exe).
+
+    The PATH directories are indexed on first use, and the index is refreshed
+    when PATH or a directory changes.
     @raise NotFound: The executable was not found in path.
     @raise ValueError: An invalid filename was passed.
     """
-    if os.path.sep in executable:
-        raise ValueError("Invalid filename: %s" % executable)
+    return resolve_paths([executable])[0]
+
+def resolve_paths(executables):
+    """Resolve names of executables into absolute paths.
+
+    See L{resolve_path}.
+    @return: List of paths, corresponding to the executables.
+    @raise NotFound: An executable was not found in path.
+    @raise ValueError: An invalid filename was passed.
+    """
+    for executable in executables:
+        if os.path.sep in executable:
+            raise ValueError("Invalid filename: %s" % executable)
     if get_os_name() == Os_Windows:    # pragma: optional
         try: import win32api, pywintypes
         except ImportError: pass
         else:
-            try: exepath = win32api.FindExecutable(executable)[1]
-            except pywintypes.error: raise NotFound(executable)
-            return exepath
+            exepaths = []
+            for executable in executables:
+                try: exepaths.append(win32api.FindExecutable(executable)[1])
+                except pywintypes.error: raise NotFound(executable)
+            return exepaths
 
     # Default solution, search path ourselves
 
-    path = os.environ.get("PATH", "").split(os.pathsep)
     if get_os_name() == Os_Windows:
         # PATHEXTS tells us which extensions an executable may have
         path_exts = os.environ.get("PATHEXTS", ".exe;.bat;.cmd").split(";")
-        has_ext = os.path.splitext(executable)[1] in path_exts
-        if not has_ext:
-            exts = path_exts
-        else:
-            # Don't try to append any extensions
-            exts = [""]
-    else:
-        # General, executables don't have extensions
-        exts = [""]
-    for d in path:
-        try:
-            for ext in exts:
-                exepath = os.path.join(d, executable + ext)
-                if os.access(exepath, os.X_OK):
-                    return exepath
-        except OSError:
-            pass
-
-    raise NotFound(executable)
+        # Executables with one of the extensions are resolved without
+        # appending any
+        exepaths = []
+        for executable in executables:
+            if os.path.splitext(executable)[1] in path_exts:
+                exts = ("",)
+            else:
+                exts = tuple(path_exts)
+            exepaths += _executable_index.resolve([executable], exts)
+        return exepaths
+    # General, executables don't have extensions
+    return _executable_index.resolve(executables, ("",))
 
 #}
 